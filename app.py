@@ -1,33 +1,53 @@
 import os
 import math
+import multiprocessing
+import numpy as np
 import dash
 import dash_bootstrap_components as dbc
 import pandas as pd
-import plotly.express as px
-import json
 import redis
-import subprocess
-import requests
 import pytz
 import logging
+import resource
 import secrets
+import threading
+import time
 from flask_sslify import SSLify
-from dash import dcc, html, Input, Output, dash_table, State
+from dash import ctx, dcc, html, Input, Output, dash_table, State
+from dash.exceptions import PreventUpdate
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, jsonify, session, request
+from flask import Flask, Response, g, jsonify, session, request
 from flask_session import Session
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from snapshot import AVAILABILITY_STATUS_IDS, aggregate_shelters, fold_text, format_display, get_formated_data, get_frame, get_snapshot, get_snapshot_memory, get_snapshot_version, select_shelters, start_snapshot_subscriber, summarize_shelters, with_text
+from result_cache import get_cached_result, get_result_cache_bytes, get_result_cache_stats
+from geo import distance_haversine, nearest
+from map_lod import MAP_ZOOM, cluster_traces, get_map_level, get_map_view, in_view
+from figures import MAP_CENTER, base_map_figure, base_pie_figure, map_patch, pie_patch, point_traces
+from refresh_lock import get_refresh_stats, run_refresh
+from geolocation import SKIP_LOCATION_PATHS, fetch_location, get_location, get_location_stats
+from metrics import dump_profile, get_profile_sample_rate, increment, instrument_redis, observe, render_metrics, set_gauge, set_profile_sample_rate, start_profile, timed
 
 logging.getLogger().setLevel(logging.INFO)
 
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-client = redis.Redis.from_url(redis_url)
+client = instrument_redis(redis.Redis.from_url(redis_url), 'app')
+refresh_pool = None
 
 COLORS = 1
 DEFAULT_LANGUAGE = 'pt-br'
+DEFAULT_LOCATION = (DEFAULT_LANGUAGE, None, None, '', 'America/Sao_Paulo')
 SECRET_KEY = secrets.token_hex(16)
 CALL_API_MINUTES = int(os.getenv('CALL_API_MINUTES', 15))
 FLASK_ENV = os.getenv('FLASK_ENV')
+APP_TABLE_PAGE_SIZE = int(os.getenv('APP_TABLE_PAGE_SIZE', 25))
+# 'thread' runs the refresh inside this worker, 'process' in a child process
+REFRESH_MODE = os.getenv('REFRESH_MODE', 'thread')
+# 'lazy' builds the snapshot on first use, or in the background from start_worker; 'eager' builds it at import
+APP_STARTUP = os.getenv('APP_STARTUP', 'lazy')
+# Sent as the X-Profiling-Token header to change the profiling rate; unset, it can only be set with PROFILE_SAMPLE_RATE
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN')
 
 dict_config = {
     1: {'backgroundColor': '#0E0F0E', 'fontColor': 'white', 'map_style': 'carto-darkmatter', 'font-family': 'Georgia, serif'},
@@ -62,106 +82,107 @@ dict_columns = {
     'SheltersVerified': {'pt-br': 'Verificados', 'en': 'Verified'},
     'SheltersNotVerified': {'pt-br': 'Nāo Verificados', 'en': 'Not Verified'},
     'Search': {'pt-br': 'Buscar por abrigo ou endereço', 'en': 'Search for shelter or address'},
+    'Within': {'pt-br': 'Até', 'en': 'Within'},
+    'Nearest': {'pt-br': 'mais próximos', 'en': 'nearest'},
+    'NoLocation': {'pt-br': 'Sua localização não é conhecida, nenhum abrigo pode ser filtrado pela distância.', 'en': 'Your location is unknown, no shelter can be filtered by distance.'},
     'AvailabilityStatus': {
-        'Available': {'statusId': 1, 'pt-br': 'Disponível', 'en': 'Available', 'color': '#2ECC40'},
-        'Check': {'statusId': 2, 'pt-br': 'Consultar', 'en': 'Check', 'color': '#00BFFF'},
-        'Crowded': {'statusId': 3, 'pt-br': 'Cheio', 'en': 'Crowded', 'color': '#FFB347'},
-        'Full': {'statusId': 4, 'pt-br': 'Lotado', 'en': 'Full', 'color': '#FF6347'},
+        'Available': {'statusId': AVAILABILITY_STATUS_IDS['Available'], 'pt-br': 'Disponível', 'en': 'Available', 'color': '#2ECC40'},
+        'Check': {'statusId': AVAILABILITY_STATUS_IDS['Check'], 'pt-br': 'Consultar', 'en': 'Check', 'color': '#00BFFF'},
+        'Crowded': {'statusId': AVAILABILITY_STATUS_IDS['Crowded'], 'pt-br': 'Cheio', 'en': 'Crowded', 'color': '#FFB347'},
+        'Full': {'statusId': AVAILABILITY_STATUS_IDS['Full'], 'pt-br': 'Lotado', 'en': 'Full', 'color': '#FF6347'},
         'Location': {'statusId': 5, 'pt-br': 'Sua Localização', 'en': 'Your Location', 'color': fontColor},
     }
 }
 
 dict_availabilityStatus = dict_columns['AvailabilityStatus']
 
+# Distance filter options: shelters within these Km of the user, or the NEAREST_SHELTERS nearest
+DISTANCE_FILTER_KM = [5, 10, 25, 50]
+NEAREST_SHELTERS = 10
+NEAREST_API_MAX_K = 100
+NEAREST_API_COLUMNS = ['id', 'name', 'address', 'city', 'latitude', 'longitude', 'capacity', 'shelteredPeople', 'availability', 'updatedAt']
+
+# Columns the shelter table shows, plus availability for its row colors
+TABLE_COLUMNS = ['link', 'address', 'capacity_info', 'vacancies', 'distance_km', 'updatedAt', 'availability']
+# Sorting by a display column sorts by the typed column behind it, missing values always go last
+TABLE_SORT_COLUMNS = {'distance_km': 'distance_km2', 'link': 'name', 'capacity_info': 'shelteredPeople'}
+# Text columns of the snapshot behind the table columns, decoded for the rows of the page only
+TABLE_TEXT_COLUMNS = ['id', 'name', 'address']
+
 dict_rename = {
     'availability': 'availability',
     'link': 'link',
 }
 
-def get_data():
-    shelter_data = client.get('shelters')
-    if shelter_data:
-        return json.loads(shelter_data)
-    else:
-        with open('shelters.json', 'r') as file:
-            return json.load(file)
-
-def distance_haversine(lon1, lat1, lon2, lat2):
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
-
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-
-    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371
-
-    distance = c * r
-    if math.isnan(distance):
-        return ["", distance]
-    else:
-        return [f"{round(distance, 1)} Km", distance]
-
-def map_availability(row, key):
-    if pd.isnull(row['capacity']) or pd.isnull(row['shelteredPeople']):
-        status = 'Check'
-    elif row['shelteredPeople'] > row['capacity']:
-        status = 'Full'
-    elif row['shelteredPeople'] == row['capacity']:
-        status = 'Crowded'
-    else:
-        status = 'Available'
-    
-    return dict_availabilityStatus[status][key]
-
-def create_link(row):
-    icons = f"{row['pet_icon']}"
-    return f"{icons} [{row['name']}](https://sos-rs.com/abrigo/{row['id']})"
-
-def format_date(data_original):
-    data_datetime = pd.to_datetime(data_original)
-    return data_datetime.strftime("%d/%m/%Y %H:%M:%S")
-
-def calculate_vacancies(row):
-    if row['capacity'] >= 0 and row['shelteredPeople'] >= 0:
-        return row['capacity'] - row['shelteredPeople']
-    else:
-        return "-"
-
-def get_formated_data():
-    df = pd.json_normalize(get_data())
-    df['pet_icon'] = df['petFriendly'].apply(lambda x: '🐾' if x else '')
-    df['verification_icon'] = df['verified'].apply(lambda x: '✔️' if x else '❌')
-    df['capacity_info'] = df.apply(lambda row: f"{int(row['shelteredPeople']) if pd.notnull(row['shelteredPeople']) else '-'}/{int(row['capacity']) if pd.notnull(row['capacity']) else '-'}", axis=1)
-    df['vacancies'] = df.apply(calculate_vacancies, axis=1)
-    df['link'] = df.apply(create_link, axis=1)# Creates Markdown column with the source API url
-    df['updatedAt'] = df['updatedAt'].apply(format_date)
-    df = df.sort_values(by='updatedAt', ascending=False)
-    df['availability'] = df.apply(lambda row: map_availability(row, 'statusId'), axis=1)
-    return df
-
 def data_cities(df, language):
-    df['city'] = df['city'].fillna('').astype(str)
-    cities = df['city'].unique()
-    city_options = [{'label': city, 'value': city} for city in cities if city is not None and city != '']
+    cities = df['city'].dropna().astype(str).unique()
+    city_options = [{'label': city, 'value': city} for city in cities if city != '']
     city_options = sorted(city_options, key=lambda x: x['label'])
     city_options.insert(0, {'label': dict_columns['AllCities'][language], 'value': dict_columns['AllCities'][language]})
     return city_options
 
-def update_shelter_data():
+def distance_options(language):
+    options = [{'label': dict_columns['All'][language], 'value': dict_columns['All'][language]}]
+    options += [{'label': f"{dict_columns['Within'][language]} {km} Km", 'value': f'km:{km}'} for km in DISTANCE_FILTER_KM]
+    options.append({'label': f"{NEAREST_SHELTERS} {dict_columns['Nearest'][language]}", 'value': f'nearest:{NEAREST_SHELTERS}'})
+    return options
+
+def get_near_filter(distance, lat, lon):
+    # filter_shelters near tuple for a distance filter value, None without a filter. Without a user location
+    # the tuple keeps lat/lon None and matches no shelter, rather than dropping the filter
+    if not distance or ':' not in str(distance):
+        return None
+    kind, value = distance.split(':')
+    return (lat, lon, float(value), None) if kind == 'km' else (lat, lon, None, int(value))
+
+def get_refresh_pool():
+    global refresh_pool
+    if refresh_pool is None:
+        # Forked from a clean server process: forking this worker would copy locks its subscriber, scheduler
+        # and geolocation threads may hold at that moment, and the child could wait on them forever
+        refresh_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('forkserver'))
+    return refresh_pool
+
+def record_refresh_metrics(stats):
+    # The stats come back from the refresh, so this also covers refreshes run in the child process
+    increment('shelters_refreshes_total', mode=stats['mode'])
+    set_gauge('shelters_refresh_duration_seconds', stats['duration_seconds'], mode=stats['mode'])
+    for phase, seconds in stats.get('phase_seconds', {}).items():
+        set_gauge('shelters_refresh_phase_seconds', seconds, mode=stats['mode'], phase=phase)
+    for rows in ['rows_fetched', 'rows_kept', 'rows_removed']:
+        if rows in stats:
+            set_gauge('shelters_refresh_rows', stats[rows], mode=stats['mode'], rows=rows.split('_')[1])
+    # Schema drift of the last refresh: shelters the decoder rejected, fields the API added or stopped sending
+    schema_drift = stats.get('schema_drift', {})
+    set_gauge('shelters_schema_invalid_records', schema_drift.get('invalid_records', 0), mode=stats['mode'])
+    set_gauge('shelters_schema_unknown_fields', len(schema_drift.get('unknown_fields', [])), mode=stats['mode'])
+    set_gauge('shelters_schema_missing_fields', len(schema_drift.get('missing_fields', [])), mode=stats['mode'])
+
+def refresh_shelter_data():
+    # Imported here, get_api_data pulls in requests and msgspec, which a worker only needs once it refreshes
+    from get_api_data import refresh_shelters
     logging.info("Running update_shelter_data")
     try:
-        result = subprocess.run(['python', 'get_api_data.py'], capture_output=True, text=True)
-        if result.returncode != 0:
-            logging.error(f"Error updating data: {result.stderr}")
+        if REFRESH_MODE == 'process':
+            # Opt-in isolation: the refresh runs in a long-lived child process instead of this worker
+            stats = get_refresh_pool().submit(refresh_shelters).result()
         else:
-            current_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            logging.info(f"Result of update: {result.stdout}")
-            client.set('last_update', current_time)
-            logging.info(f"Data updated successfully {current_time} (UTC)")
+            stats = refresh_shelters()
+        current_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        logging.info(f"Result of update: {stats}")
+        record_refresh_metrics(stats)
+        client.set('last_update', current_time)
+        logging.info(f"Data updated successfully {current_time} (UTC)")
+        return stats
     except Exception as e:
+        increment('shelters_refresh_failures_total')
         logging.error(f"Exception during data update: {e}")
 
+def update_shelter_data(scheduled=False):
+    # One refresh at a time across every worker, see refresh_lock
+    interval_seconds = scheduler.get_job('update_job').trigger.interval.total_seconds()
+    return run_refresh(refresh_shelter_data, scheduled, interval_seconds)
+
 def get_last_update_time():
     last_update = client.get('last_update')
     if last_update:
@@ -172,25 +193,20 @@ def get_last_update_time():
         return last_update_local.strftime('%Y-%m-%d %H:%M:%S')
     return ''
 
+def get_request_ip():
+    if FLASK_ENV == 'production':
+        return request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0]
+    return "193.19.205.155"
+
+def fetch_dev_location(ip):
+    return {'ip': '193.19.205.155','city': 'Barra do Ribeiro','region': 'São Paulo','country': 'BR','loc': '-30.300278,-51.30477','timezone': 'America/Sao_Paulo'}
+
 def get_user_language_and_location():
+    # None while the location of the request address is looked up in the background
     try:
-        if FLASK_ENV == 'production':
-            ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0]
-        else:
-            ip = "193.19.205.155"
-
-        cached_response = client.get(f"user_location:{ip}")
-        if cached_response:
-            logging.info(f"{datetime.utcnow()}:{ ip = }is cached")
-            response = json.loads(cached_response)
-        else:
-            if FLASK_ENV == 'production':
-                response = requests.get(f'https://ipinfo.io/{ip}/json').json()
-                logging.info(f"{datetime.utcnow()}:{ ip = }{response=}")
-            else:
-                response = {'ip': '193.19.205.155','city': 'Barra do Ribeiro','region': 'São Paulo','country': 'BR','loc': '-30.300278,-51.30477','timezone': 'America/Sao_Paulo'}
-            client.setex(f"user_location:{ip}", timedelta(hours=24), json.dumps(response))
-            logging.info(f"{datetime.utcnow()}:{ ip = }added to Redis.")
+        response = get_location(get_request_ip(), fetch_location if FLASK_ENV == 'production' else fetch_dev_location)
+        if response is None:
+            return None
 
         loc = response.get('loc')
         country = response.get('country')
@@ -199,15 +215,11 @@ def get_user_language_and_location():
 
         if loc:
             lat, lon = loc.split(',')
-            return ('pt-br' if country == 'BR' else 'en', float(lat), float(lon), city, timezone)
-        else:
-            return DEFAULT_LANGUAGE, None, None, '', 'America/Sao_Paulo'
+            return ('pt-br' if country == 'BR' else 'en', float(lat), float(lon), city, timezone or 'America/Sao_Paulo')
     except Exception as e:
+        # A Redis error or a malformed cached response: the session keeps the default location
         logging.error(f"Error determining user location: {e}")
-    if FLASK_ENV == 'production':
-        return DEFAULT_LANGUAGE, None, None, '', 'America/Sao_Paulo'
-
-df = get_formated_data()
+    return DEFAULT_LOCATION
 
 server = Flask(__name__)
 server.config['SECRET_KEY'] = SECRET_KEY
@@ -215,7 +227,7 @@ server.config['SESSION_TYPE'] = 'redis'
 server.config['SESSION_PERMANENT'] = False
 server.config['SESSION_USE_SIGNER'] = True
 server.config['SESSION_KEY_PREFIX'] = 'session:'
-server.config['SESSION_REDIS'] = redis.from_url(redis_url)
+server.config['SESSION_REDIS'] = instrument_redis(redis.from_url(redis_url), 'session')
 server.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=60)
 Session(server)
 
@@ -251,29 +263,141 @@ if 'DYNO' in os.environ:  # Only trigger SSLify if on Heroku
 
 @server.before_request
 def before_request():
+    start_worker()
+    if request.path == '/_dash-update-component':
+        g.callback_start = time.perf_counter()
+        g.profiler = start_profile()
+    if request.path.startswith(SKIP_LOCATION_PATHS):
+        return
     session.permanent = True
     if 'language' not in session or 'lat' not in session or 'lon' not in session:
-        user_language, lat, lon, city, timezone = get_user_language_and_location()
-        session['language'] = user_language
-        session['lat'] = lat
-        session['lon'] = lon
-        session['city'] = city
-        session['timezone'] = timezone
+        # Served with the defaults right away, the location fills in once its lookup is done
+        session['language'], session['lat'], session['lon'], session['city'], session['timezone'] = DEFAULT_LOCATION
+        session['location_pending'] = True
         session['initialized'] = True
+    if session.get('location_pending'):
+        location = get_user_language_and_location()
+        if location is None:
+            return
+        user_language, session['lat'], session['lon'], session['city'], session['timezone'] = location
+        # A language the user picked meanwhile is kept
+        if not session.get('language_chosen'):
+            session['language'] = user_language
+        session['location_pending'] = False
         logging.info(f"Session - {datetime.utcnow()}: {session['language']}, {session['lat']}, {session['lon']}, {session['city']}, {session['timezone']}")
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(update_shelter_data, 'interval', minutes=CALL_API_MINUTES, id='update_job')
-scheduler.start()
+@server.after_request
+def after_request(response):
+    # Latency and response size of each Dash callback, labelled by its outputs
+    if 'callback_start' in g:
+        output = (request.get_json(silent=True) or {}).get('output', '')
+        observe('shelters_callback_seconds', time.perf_counter() - g.callback_start, output=output)
+        set_gauge('shelters_callback_response_bytes', len(response.get_data()), output=output)
+        if g.profiler is not None:
+            dump_profile(g.profiler, output)
+    return response
+
+def create_scheduler():
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(update_shelter_data, 'interval', minutes=CALL_API_MINUTES, id='update_job', kwargs={'scheduled': True})
+    return scheduler
+
+scheduler = create_scheduler()
+
+_worker = {'pid': None}
+_worker_lock = threading.Lock()
+
+def start_worker():
+    # The snapshot subscriber and the scheduler are threads, which do not survive a fork: each process starts
+    # its own, from the gunicorn post_worker_init hook or on its first request. The subscriber builds or maps
+    # the snapshot as soon as it connects, so it also warms the worker up in the background
+    global scheduler
+    with _worker_lock:
+        if _worker['pid'] == os.getpid():
+            return
+        _worker['pid'] = os.getpid()
+        start_snapshot_subscriber()
+        if scheduler.running:
+            # Started by the process this one was forked from; the copy still says running but has no thread
+            scheduler = create_scheduler()
+        scheduler.start()
+
+if APP_STARTUP == 'eager':
+    # Build the snapshot before serving. Under gunicorn --preload this runs in the master and the workers
+    # inherit it, their threads are only started after the fork
+    get_formated_data()
 
 @server.route('/update-data', methods=['GET'])
 def update_data():
     try:
-        update_shelter_data()
-        return jsonify({"message": "Data update triggered"})
+        stats = update_shelter_data()
+        return jsonify({"message": "Data update triggered", "stats": stats})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@server.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_result_cache_stats())
+
+@server.route('/refresh-stats', methods=['GET'])
+def refresh_stats():
+    return jsonify(get_refresh_stats())
+
+@server.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format; every gunicorn worker has its own metrics
+    for name, stats in [('result_cache', get_result_cache_stats()), ('refresh', get_refresh_stats()), ('location', get_location_stats())]:
+        for stat, value in stats.items():
+            set_gauge(f'shelters_{name}_{stat}', value)
+    set_gauge('shelters_snapshot_version', int(get_snapshot_version() or 0))
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@server.route('/profiling', methods=['GET', 'POST'])
+def profiling():
+    # POST {"sample_rate": 0.01} profiles 1% of the callbacks into PROFILE_DIR, 0 stops
+    if request.method == 'POST':
+        token = request.headers.get('X-Profiling-Token', '')
+        if not PROFILING_TOKEN or not secrets.compare_digest(token.encode(), PROFILING_TOKEN.encode()):
+            return jsonify({"error": "A valid X-Profiling-Token header is required"}), 403
+        try:
+            set_profile_sample_rate((request.get_json(silent=True) or {}).get('sample_rate', 0))
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({"error": "sample_rate must be a finite number"}), 400
+    return jsonify({"sample_rate": get_profile_sample_rate()})
+
+@server.route('/location-stats', methods=['GET'])
+def location_stats():
+    return jsonify(get_location_stats())
+
+@server.route('/memory-stats', methods=['GET'])
+def memory_stats():
+    # Memory of this worker only, each gunicorn worker holds its own snapshot and result cache
+    return jsonify({
+        'pid': os.getpid(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'snapshot': get_snapshot_memory(),
+        'result_cache_bytes': get_result_cache_bytes(),
+    })
+
+@server.route('/api/shelters/nearest', methods=['GET'])
+def nearest_shelters():
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = int(request.args.get('k', NEAREST_SHELTERS))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lon are required numbers, k an optional integer"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < k <= NEAREST_API_MAX_K):
+        return jsonify({"error": f"lat/lon out of range or k not between 1 and {NEAREST_API_MAX_K}"}), 400
+
+    snapshot = get_snapshot()
+    rows, distances = nearest(snapshot['geo'], lat, lon, k)
+    shelters = get_frame(snapshot, rows)[NEAREST_API_COLUMNS].assign(distance_km=distances.round(3))
+    shelters['city'] = shelters['city'].astype(object).where(shelters['city'].notna(), None)
+    shelters[['latitude', 'longitude']] = shelters[['latitude', 'longitude']].astype('float64').round(6)
+    shelters['updatedAt'] = shelters['updatedAt'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return jsonify({"version": snapshot['version'], "shelters": shelters.to_dict('records')})
+
 @server.route('/update-interval', methods=['POST'])
 def update_interval():
     new_interval = request.json.get('interval', CALL_API_MINUTES)
@@ -284,11 +408,13 @@ def update_interval():
 @server.route('/pt-br')
 def pt_br():
     session['language'] = 'pt-br'
+    session['language_chosen'] = True
     return app.index()
 
 @server.route('/en')
 def en():
     session['language'] = 'en'
+    session['language_chosen'] = True
     return app.index()
 
 app.layout = dbc.Container([
@@ -357,6 +483,15 @@ app.layout = dbc.Container([
                 style={'color': 'black'}
             )
         ], xs=12, sm=12, md=6, lg=3, className="mb-1"),
+        dbc.Col([
+            html.Label(id='distance-label', style={'color': fontColor}),
+            dcc.Dropdown(
+                id='distance-filter',
+                clearable=False,
+                style={'color': 'black'}
+            ),
+            html.Small(id='distance-notice', style={'color': fontColor})
+        ], xs=12, sm=12, md=6, lg=3, className="mb-1"),
     ], style={'backgroundColor': backgroundColor, 'margin-bottom': '4px'}),
     # Graphs
     dbc.Row([
@@ -371,18 +506,21 @@ app.layout = dbc.Container([
         ], xs=12, sm=12, md=6, lg=3, className="mb-2"),
         dbc.Col([
             dbc.Button(id="hide-map"),
-            dcc.Graph(id='map', style={'display': 'block'})
+            dcc.Graph(id='map', figure=base_map_figure(backgroundColor, fontColor, map_style, MAP_ZOOM), style={'display': 'block'}),
+            dcc.Store(id='map-level')
         ], xs=12, sm=12, md=6, lg=6, className="mb-2"),
         dbc.Col([
             dbc.Button(id="hide-city-distribution"),
-            dcc.Graph(id='city-distribution', style={'display': 'block'})
+            dcc.Graph(id='city-distribution', figure=base_pie_figure(backgroundColor, fontColor), style={'display': 'block'})
         ], xs=12, sm=12, md=6, lg=3, className="mb-2"),
         ], style={'backgroundColor': backgroundColor, 'textAlign': 'center'} 
     ),
     # Table
     dbc.Row([
         dbc.Col(html.Div(id='shelter-table-div'), width=12)
-    ])
+    ]),
+    # Filters of the current result, the map, pie, info and table callbacks render from it
+    dcc.Store(id='filter-result')
 ], fluid=True, style={'backgroundColor': backgroundColor})
 
 @app.callback(
@@ -444,6 +582,9 @@ def hide_city_distribution(n_clicks, current_style):
      Output('pet-label', 'children'),
      Output('pet-filter', 'options'),
      Output('pet-filter', 'value'),
+     Output('distance-label', 'children'),
+     Output('distance-filter', 'options'),
+     Output('distance-filter', 'value'),
      Output('hide-info', 'children'),
      Output('hide-map', 'children'),
      Output('hide-city-distribution', 'children'),
@@ -462,16 +603,19 @@ def hide_city_distribution(n_clicks, current_style):
      State('verification-filter', 'value'),
      State('pet-label', 'children'),
      State('pet-filter', 'options'),
-     State('pet-filter', 'value')]
+     State('pet-filter', 'value'),
+     State('distance-label', 'children'),
+     State('distance-filter', 'options'),
+     State('distance-filter', 'value')]
 )
-def update_language(pt_clicks, en_clicks, search_placeholder, city_label, city_options, city_values, availability_label, availability_options, availability_values, verification_label, verification_options, verification_values, pet_label, pet_options, pet_values):
+def update_language(pt_clicks, en_clicks, search_placeholder, city_label, city_options, city_values, availability_label, availability_options, availability_values, verification_label, verification_options, verification_values, pet_label, pet_options, pet_values, distance_label, distance_filter_options, distance_values):
     language = session.get('language', DEFAULT_LANGUAGE)
     if en_clicks and (not pt_clicks or en_clicks > pt_clicks):
         language = 'en'
     elif pt_clicks and (not en_clicks or pt_clicks > en_clicks):
         language = 'pt-br'
     
-    city_options = data_cities(df, language)
+    city_options = data_cities(get_formated_data(), language)
     last_update_time = f"{dict_columns['UpdatedAt'][language]}: {get_last_update_time()}"
 
     availability_options = [
@@ -501,6 +645,7 @@ def update_language(pt_clicks, en_clicks, search_placeholder, city_label, city_o
     simple_values = dict_columns['All'][language]
     verification_values = simple_values
     pet_values = simple_values
+    distance_values = simple_values
     
     return (f"{dict_columns['Shelter'][language]}s - Rio Grande do Sul",
             dict_columns['Search'][language],
@@ -516,181 +661,245 @@ def update_language(pt_clicks, en_clicks, search_placeholder, city_label, city_o
             dict_columns['Pet'][language]+':',
             pet_options,
             pet_values,
+            dict_columns['Distance'][language]+':',
+            distance_options(language),
+            distance_values,
             dict_columns['Hide'][language],
             dict_columns['Hide'][language],
             dict_columns['Hide'][language],
             last_update_time)
 
+def get_status_styles(language):
+    return {status['statusId']: {'name': status[language], 'color': status['color']} for status in dict_availabilityStatus.values()}
+
+def is_hidden(style):
+    return (style or {}).get('display') == 'none'
+
+def build_filter_result(snapshot, filters):
+    # Rows of the filtered shelters every panel renders from; nothing here depends on the language or the user
+    # location. Only the row numbers are cached, the panels take the columns they need from the snapshot
+    return select_shelters(snapshot=snapshot, **filters)
+
+def get_callback_language(pt_clicks, en_clicks):
+    language = session.get('language')
+    if en_clicks and (not pt_clicks or en_clicks > pt_clicks):
+        language = 'en'
+    elif pt_clicks and (not en_clicks or pt_clicks > en_clicks):
+        language = 'pt-br'
+    return language
+
+def get_filters(search, city, verification, pet, availability, distance, language):
+    all_values = dict_columns['All'][language]
+    return {
+        'search': fold_text(pd.Series([search])).iloc[0] if search else None,
+        'cities': tuple(sorted(city)) if city and dict_columns['AllCities'][language] not in city else None,
+        'availability': tuple(sorted(availability)) if availability and all_values not in availability else None,
+        'verified': verification if verification != all_values else None,
+        'pet_friendly': pet if pet != all_values else None,
+        'near': get_near_filter(distance, session.get('lat'), session.get('lon')),
+    }
+
+def get_filter_result(filters):
+    # The snapshot and the filtered rows, which only mean something together with the snapshot they index
+    snapshot = get_snapshot()
+    if snapshot['version'] is None:
+        return snapshot, build_filter_result(snapshot, filters)
+    key = (filters['search'], filters['cities'], filters['availability'], filters['verified'], filters['pet_friendly'], filters['near'], snapshot['version'])
+    return snapshot, get_cached_result(key, lambda: build_filter_result(snapshot, filters))
+
+def get_stored_filters(data):
+    if data is None:
+        raise PreventUpdate
+    return {name: tuple(value) if isinstance(value, list) else value for name, value in data['filters'].items()}, data['language']
+
+def get_stored_result(data):
+    # Filter result of the filter-result store, rebuilt when this worker does not have it cached
+    filters, language = get_stored_filters(data)
+    return get_filter_result(filters), language
+
+def get_stored_totals(data):
+    # KPI and pie numbers of the stored filters: from the snapshot cube unless a search or distance filter
+    # needs the filtered shelters themselves
+    filters, language = get_stored_filters(data)
+    if filters['search'] is None and filters['near'] is None:
+        with timed('totals_cube'):
+            return aggregate_shelters(get_snapshot(), filters['cities'], filters['availability'], filters['verified'], filters['pet_friendly']), language
+    snapshot, rows = get_filter_result(filters)
+    with timed('totals_scan'):
+        return summarize_shelters(snapshot['df'].take(rows)), language
+
+def get_session_table(snapshot, rows):
+    # Typed columns of the filtered shelters nearest first; only the distance depends on the session
+    with timed('take_rows'):
+        filtered_df = snapshot['df'].take(rows)
+    with timed('haversine'):
+        distances, distance_labels = distance_haversine(filtered_df['latitude'], filtered_df['longitude'], session.get('lat'), session.get('lon'))
+    filtered_df = filtered_df.assign(distance_km=distance_labels, distance_km2=distances)
+    with timed('table_sort'):
+        return filtered_df.sort_values(by=['distance_km2'], ascending=[True], na_position='last')
+
+def get_table_page(snapshot, filtered_df, page_current, page_size, sort_by):
+    if sort_by:
+        column = sort_by[0]['column_id']
+        column = TABLE_SORT_COLUMNS.get(column, column)
+        if column in snapshot['texts']:
+            # Sorting by a text column needs it decoded for every filtered shelter
+            filtered_df = with_text(snapshot, filtered_df, [column])
+        filtered_df = filtered_df.sort_values(
+            by=column,
+            ascending=sort_by[0]['direction'] == 'asc',
+            na_position='last',
+            kind='stable',
+        )
+    page = filtered_df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    with timed('table_records'):
+        return format_display(with_text(snapshot, page, TABLE_TEXT_COLUMNS))[TABLE_COLUMNS].to_dict('records')
+
+def get_map_traces(snapshot, rows, zoom, bounds, language):
+    level = get_map_level(zoom)
+    df = snapshot['df']
+    latitudes = df['latitude'].to_numpy()[rows].astype('float64')
+    longitudes = df['longitude'].to_numpy()[rows].astype('float64')
+    availability = df['availability'].to_numpy()[rows]
+    if level is None:
+        # Past the clusters only the shelters in view are sent, their names decoded for them alone
+        labels = {
+            'city': dict_columns['City'][language],
+            'capacity': dict_columns['Capacity'][language],
+            'shelteredPeople': dict_columns['AmountOfPeopleSheltered'][language],
+            'availability': dict_columns['Availability'][language]
+        }
+        visible = get_frame(snapshot, rows[in_view(latitudes, longitudes, bounds)], ['name'])
+        return point_traces(visible, get_status_styles(language), labels, set(np.unique(availability).tolist()))
+    return cluster_traces(snapshot['clusters'][level][rows], latitudes, longitudes, availability,
+                          get_status_styles(language), dict_columns['AmountOfShelters'][language])
+
 @app.callback(
-    [Output('map', 'figure'),
-     Output('city-distribution', 'figure'),
-     Output('num-shelters-div', 'children'),
-     Output('total-people-div', 'children'),
-     Output('verified-shelters-div', 'children'),
-     Output('not-verified-shelters-div', 'children'),
-     Output('pet-friendly-shelters-div', 'children'),
-     Output('shelter-table-div', 'children')],
+    Output('filter-result', 'data'),
     [Input('search-filter', 'value'),
      Input('city-filter', 'value'),
      Input('verification-filter', 'value'),
      Input('pet-filter', 'value'),
      Input('availability-filter', 'value'),
+     Input('distance-filter', 'value'),
      Input('pt-br', 'n_clicks'),
-     Input('en', 'n_clicks')],
-    [State('map', 'figure')]
+     Input('en', 'n_clicks')]
 )
-def update_data(search, city, verification, pet, availability, pt_clicks, en_clicks, map_figure):
-    APP_TABLE_PAGE_SIZE =  int(os.getenv('APP_TABLE_PAGE_SIZE',25))
-    language = session.get('language')
-    if en_clicks and (not pt_clicks or en_clicks > pt_clicks):
-        language = 'en'
-    elif pt_clicks and (not en_clicks or pt_clicks > en_clicks):
-        language = 'pt-br'
-
-    filtered_df = get_formated_data()
-    
-    if search:
-        search = search.lower()
-        filtered_df = filtered_df[
-            filtered_df.apply(
-                lambda row: row.astype(str).str.lower().str.contains(search).any(), axis=1
-            )
-        ]
+def update_filter_result(search, city, verification, pet, availability, distance, pt_clicks, en_clicks):
+    # Filters the shelters once into the result cache; the map, pie, KPI and table callbacks below render
+    # from it on their own, and only the filters travel through the store
+    language = get_callback_language(pt_clicks, en_clicks)
+    filters = get_filters(search, city, verification, pet, availability, distance, language)
+    get_filter_result(filters)
+    return {'filters': filters, 'language': language}
 
-    if dict_columns['AllCities'][language] not in city and len(city) > 0:
-        filtered_df = filtered_df[filtered_df['city'].isin(city)]
+@app.callback(
+    Output('distance-notice', 'children'),
+    Input('filter-result', 'data')
+)
+def update_distance_notice(data):
+    filters, language = get_stored_filters(data)
+    if filters['near'] is not None and filters['near'][0] is None:
+        return dict_columns['NoLocation'][language]
+    return ''
 
-    if dict_columns['All'][language] not in availability and len(availability) > 0:
-        filtered_df = filtered_df[filtered_df['availability'].isin(availability)]
-    
-    if dict_columns['All'][language] != verification:
-        filtered_df = filtered_df[filtered_df['verified'] == verification]
+@app.callback(
+    [Output('map', 'figure'),
+     Output('map-level', 'data')],
+    [Input('filter-result', 'data'),
+     Input('map', 'relayoutData'),
+     Input('map', 'style')],
+    [State('map-level', 'data')]
+)
+def update_map(data, relayout_data, style, map_level):
+    # A hidden map renders nothing until it is shown again
+    if is_hidden(style):
+        raise PreventUpdate
+    zoom, bounds = get_map_view(relayout_data)
+    level = get_map_level(zoom)
+    # Panning or zooming within the same cluster level changes nothing in the clustered map
+    if list(ctx.triggered_prop_ids) == ['map.relayoutData'] and level is not None and level == map_level:
+        raise PreventUpdate
+
+    (snapshot, rows), language = get_stored_result(data)
 
-    if dict_columns['All'][language] != pet:
-        filtered_df = filtered_df[filtered_df['petFriendly'] == pet]
-    
     session_lat = session.get('lat')
     session_lon = session.get('lon')
-    session_city = session.get('city')
-
-    filtered_df['availabilityDescription'] = filtered_df.apply(lambda row: map_availability(row, language), axis=1)
-
-    if filtered_df.shape[0] == 0:
-        filtered_df['distance_km'] = []
-        filtered_df['distance_km2'] = []
-    else:
-        filtered_df[['distance_km', 'distance_km2']] = filtered_df.apply(lambda row: distance_haversine(row['latitude'], row['longitude'], session_lat, session_lon), axis=1, result_type='expand')
-
-    filtered_df = filtered_df.sort_values(by=['distance_km2'], ascending=[True], na_position='last')
-    
-    # Text
-    tex_style = {'color': fontColor, 'fontWeight': 'bold'}
-    num_shelters = html.P(f"{dict_columns['AmountOfShelters'][language]}: {len(filtered_df)}", style=tex_style)
-    total_people = html.P(f"{dict_columns['AmountOfPeopleSheltered'][language]}: {int(filtered_df['shelteredPeople'].sum())}", style=tex_style)
-    verified_shelters = html.P(f"{dict_columns['SheltersVerified'][language]}: {len(filtered_df[filtered_df['verified']])}", style=tex_style)
-    not_verified_shelters = html.P(f"{dict_columns['SheltersNotVerified'][language]}: {len(filtered_df[~filtered_df['verified']])}", style=tex_style)
-    pet_friendly_shelters = html.P(f"{dict_columns['PetFriendly'][language]}: {filtered_df['petFriendly'].sum()}", style=tex_style)
-
-    # Map Graph
-    new_point = pd.DataFrame({
-        'latitude': [session_lat],
-        'longitude': [session_lon],
-        'name': dict_availabilityStatus['Location'][language],
-        'city': session_city,
-        'capacity': '',
-        'shelteredPeople': '',
-        'availabilityDescription': dict_availabilityStatus['Location'][language]
-    })
-
-    labels = {
-        'latitude': 'Latitude',
-        'longitude': 'Longitude',
-        'name': dict_columns['Shelter'][language],
-        'city': dict_columns['City'][language],
-        'capacity': dict_columns['Capacity'][language],
-        'shelteredPeople': dict_columns['AmountOfPeopleSheltered'][language],
-        'availabilityDescription': dict_columns['Availability'][language]
+    session_city = session.get('city') or ''
+
+    location = dict_availabilityStatus['Location']
+    location_trace = {
+        'type': 'scattermapbox',
+        'subplot': 'mapbox',
+        'mode': 'markers',
+        'lat': [session_lat],
+        'lon': [session_lon],
+        'name': location[language],
+        'legendgroup': location[language],
+        'showlegend': True,
+        'hovertext': [location[language]],
+        'hovertemplate': f"<b>%{{hovertext}}</b><br><br>{dict_columns['City'][language]}={session_city}<extra></extra>",
+        'marker': {'color': location['color'], 'size': 12},
     }
 
-    hover_columns = ['city', 'capacity', 'shelteredPeople', 'availabilityDescription']
-
-    map_df = pd.concat([filtered_df, new_point], ignore_index=True)
-    map_df[hover_columns] = map_df[hover_columns].fillna("")
-
-    color_availability = {
-        dict_availabilityStatus['Available'][language]: dict_availabilityStatus['Available']['color'],
-        dict_availabilityStatus['Check'][language]: dict_availabilityStatus['Check']['color'],
-        dict_availabilityStatus['Crowded'][language]: dict_availabilityStatus['Crowded']['color'],
-        dict_availabilityStatus['Full'][language]: dict_availabilityStatus['Full']['color'],
-        dict_availabilityStatus['Location'][language]: dict_availabilityStatus['Location']['color']
-    }
-
-    fig = px.scatter_mapbox(
-        map_df,
-        lat="latitude",
-        lon="longitude",
-        hover_name="name",
-        hover_data=hover_columns,
-        color="availabilityDescription",
-        color_discrete_map=color_availability,
-        labels=labels,
-        zoom=9,
-    )
-
-    fig.update_traces(marker=dict(size=12))
-
-    cities = df['city'].unique()
-    cities_lower = [city.lower() for city in cities if city is not None]
-
     # Set center based in the user location 
-    if session_city.lower() in cities_lower:
+    if session_city.lower() in {city.lower() for city in snapshot['df']['city'].cat.categories}:
         map_center = {"lat": session_lat, "lon": session_lon}
     else:
-        map_center = {"lat": -30.033056, "lon": -51.230000}
-
-    fig.update_layout(
-        mapbox_center=map_center,
-        margin={"r": 0, "t": 0, "l": 0, "b": 0},
-        paper_bgcolor=backgroundColor,
-        mapbox_style=map_style,
-        legend=dict(
-            x=0,
-            y=1,
-            title_font_family="Times New Roman",
-            font=dict(
-                family="Courier",
-                size=12,
-                color=fontColor
-            ),
-            title_text=""
-        )
-    )
-
-    # Pie Graph
-    pie_df = map_df.loc[map_df['availabilityDescription'] != dict_availabilityStatus['Location'][language]]
+        map_center = MAP_CENTER
 
-    category_counts = pie_df['availabilityDescription'].value_counts().reset_index()
-    category_counts.columns = ['availabilityDescription', 'count']
+    with timed('map_traces'):
+        traces = get_map_traces(snapshot, rows, zoom, bounds, language)
+    # The layout of the map is sent once with the page, only the traces and the center change
+    return map_patch(traces + [location_trace], map_center), level
 
-    city_distribution = px.pie(
-        category_counts,
-        names='availabilityDescription',
-        values='count',
-        hole=0.25,
-        color='availabilityDescription',
-        color_discrete_map=color_availability,
+@app.callback(
+    Output('city-distribution', 'figure'),
+    [Input('filter-result', 'data'),
+     Input('city-distribution', 'style')]
+)
+def update_city_distribution(data, style):
+    if is_hidden(style):
+        raise PreventUpdate
+    totals, language = get_stored_totals(data)
+    status_styles = get_status_styles(language)
+    # Largest first, like value_counts
+    category_counts = sorted(((count, status_id) for status_id, count in totals['availability'].items() if count), key=lambda item: -item[0])
+    return pie_patch(
+        [status_styles[status_id]['name'] for _, status_id in category_counts],
+        [count for count, _ in category_counts],
+        [status_styles[status_id]['color'] for _, status_id in category_counts],
     )
 
-    city_distribution.update_layout(
-        title_font_color=fontColor,
-        font_color=fontColor,
-        paper_bgcolor=backgroundColor,
-        plot_bgcolor=fontColor,
-    )
+@app.callback(
+    [Output('num-shelters-div', 'children'),
+     Output('total-people-div', 'children'),
+     Output('verified-shelters-div', 'children'),
+     Output('not-verified-shelters-div', 'children'),
+     Output('pet-friendly-shelters-div', 'children')],
+    [Input('filter-result', 'data'),
+     Input('num-shelters-div', 'style')]
+)
+def update_info(data, style):
+    if is_hidden(style):
+        raise PreventUpdate
+    totals, language = get_stored_totals(data)
 
-    city_distribution.update_traces(
-        hovertemplate='%{label}: %{value} <extra></extra>'
-    )
+    tex_style = {'color': fontColor, 'fontWeight': 'bold'}
+    num_shelters = html.P(f"{dict_columns['AmountOfShelters'][language]}: {totals['shelters']}", style=tex_style)
+    total_people = html.P(f"{dict_columns['AmountOfPeopleSheltered'][language]}: {totals['people']}", style=tex_style)
+    verified_shelters = html.P(f"{dict_columns['SheltersVerified'][language]}: {totals['verified']}", style=tex_style)
+    not_verified_shelters = html.P(f"{dict_columns['SheltersNotVerified'][language]}: {totals['not_verified']}", style=tex_style)
+    pet_friendly_shelters = html.P(f"{dict_columns['PetFriendly'][language]}: {totals['pet_friendly']}", style=tex_style)
+    return num_shelters, total_people, verified_shelters, not_verified_shelters, pet_friendly_shelters
+
+@app.callback(
+    Output('shelter-table-div', 'children'),
+    Input('filter-result', 'data')
+)
+def update_table(data):
+    (snapshot, rows), language = get_stored_result(data)
+    filtered_df = get_session_table(snapshot, rows)
 
     # Table
     shelter_table = dash_table.DataTable(
@@ -702,10 +911,15 @@ def update_data(search, city, verification, pet, availability, pt_clicks, en_cli
             {"name": f"{dict_columns['Distance'][language]}", "id": "distance_km", "sort_as_null": [""]},
             {"name": f"{dict_columns['UpdatedAt'][language]}", "id": "updatedAt"},
         ],
-        data=filtered_df.to_dict('records'),
-        sort_action='native',
+        id='shelter-table',
+        data=get_table_page(snapshot, filtered_df, 0, APP_TABLE_PAGE_SIZE, []),
+        page_current=0,
         page_size=APP_TABLE_PAGE_SIZE,
-        page_action='native',
+        page_count=max(1, math.ceil(len(filtered_df) / APP_TABLE_PAGE_SIZE)),
+        page_action='custom',
+        sort_action='custom',
+        sort_mode='single',
+        sort_by=[],
         style_table={'overflowX': 'auto', 'width': '100%'},
         style_header={'color': fontColor, 'backgroundColor': backgroundColor, 'textAlign': 'left', 'fontSize': '15px'},
         style_data={'whiteSpace': 'normal', 'textOverflow': 'ellipsis', 'overflow': 'hidden'},
@@ -735,11 +949,25 @@ def update_data(search, city, verification, pet, availability, pt_clicks, en_cli
         ]
     )
 
-    return fig, city_distribution, num_shelters, total_people, verified_shelters, not_verified_shelters, pet_friendly_shelters, shelter_table
+    return shelter_table
+
+@app.callback(
+    Output('shelter-table', 'data'),
+    [Input('shelter-table', 'page_current'),
+     Input('shelter-table', 'sort_by')],
+    [State('filter-result', 'data')],
+    prevent_initial_call=True
+)
+def update_table_page(page_current, sort_by, data):
+    # Page turns and sorting reuse the cached filter result instead of rendering the table again
+    (snapshot, rows), _ = get_stored_result(data)
+    return get_table_page(snapshot, get_session_table(snapshot, rows), page_current or 0, APP_TABLE_PAGE_SIZE, sort_by)
 
 if __name__ == '__main__':
     debug_mode = FLASK_ENV == 'production'
-    update_shelter_data()  # Run the update function at startup
+    # First update as soon as the scheduler starts, without holding the server back
+    scheduler.add_job(update_shelter_data, id='startup_update_job')
+    start_worker()
     logging.info("Starting the server")
     try:
         app.run_server(debug=debug_mode)
@@ -0,0 +1,47 @@
+# KPI and pie totals of a filter combination: filtering the shelters and summing them, summing an already
+# filtered frame (a result cache hit), and adding up cells of the snapshot cube. All must give the same totals.
+# Usage: python -m benchmarks.bench_aggregates [--sizes 5000 50000 500000] [--repeat 20]
+import argparse
+import time
+import pandas as pd
+from benchmarks.synthetic import make_shelters
+from snapshot import aggregate_shelters, build_search_index, filter_shelters, format_data, read_snapshot, summarize_shelters
+from snapshot_format import encode_shared_frame
+
+FILTERS = {
+    'no filter': {},
+    'one city': {'cities': ('Porto Alegre',)},
+    'two statuses': {'availability': (1, 3)},
+    'city + verified + pet': {'cities': ('Canoas', 'Guaíba'), 'verified': True, 'pet_friendly': False},
+}
+
+def timed(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'filters':>24} {'scan (ms)':>10} {'sum (ms)':>10} {'cube (ms)':>10}")
+    for size in args.sizes:
+        df = format_data(pd.json_normalize(make_shelters(size)))
+        df['search_text'] = build_search_index(df)
+        df['city'] = df['city'].astype('category')
+        snapshot = read_snapshot(encode_shared_frame(df, None))
+        for name, filters in FILTERS.items():
+            scan_time, scanned = timed(lambda: summarize_shelters(filter_shelters(snapshot=snapshot, text_columns=[], **filters)), args.repeat)
+            filtered_df = filter_shelters(snapshot=snapshot, text_columns=[], **filters)
+            sum_time, _ = timed(lambda: summarize_shelters(filtered_df), args.repeat)
+            cube_time, aggregated = timed(lambda: aggregate_shelters(snapshot, **filters), args.repeat)
+            assert scanned == aggregated, (name, scanned, aggregated)
+            print(f"{size:>8} {name:>24} {scan_time * 1000:>10.2f} {sum_time * 1000:>10.2f} {cube_time * 1000:>10.3f}")
+
+if __name__ == '__main__':
+    main()
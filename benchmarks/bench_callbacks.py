@@ -0,0 +1,295 @@
+# Load test of the dashboard callbacks. Synthetic shelters are stored in an in-process fakeredis (or the Redis at
+# --redis-url) and simulated users drive the real Dash callbacks through /_dash-update-component, from a number of
+# threads in each worker process: page loads, searches typed a key at a time, city/availability/verified/pet/distance
+# filters, language clicks and table page turns. Reports p50/p95/p99 latency per callback, throughput and the peak
+# RSS of every worker, and writes the run as JSON; --compare prints the p50/p95 change against an earlier run.
+# Usage: python -m benchmarks.bench_callbacks [--sizes 5000 50000 500000] [--concurrency 1 4 16] [--interactions 200]
+#        [--workers 1] [--redis-url redis://localhost:6379/15] [--output bench_callbacks.json] [--compare previous.json]
+# --redis-url overwrites the shelters keys of that database, point it at a scratch one. Without it fakeredis is needed.
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import redis
+from benchmarks.synthetic import CITIES, make_shelters
+
+FILTER_OUTPUT = 'filter-result.data'
+LANGUAGE_OUTPUT = 'title.children'
+TABLE_PAGE_OUTPUT = 'shelter-table.data'
+# What the browser asks once the filter result changes
+RENDER_OUTPUTS = ['map.figure', 'city-distribution.figure', 'num-shelters-div.children', 'shelter-table-div.children']
+# Interactions of a simulated user and how often they happen
+INTERACTIONS = {
+    'search': 0.3,
+    'city': 0.15,
+    'availability': 0.1,
+    'verified': 0.05,
+    'pet': 0.05,
+    'distance': 0.1,
+    'language': 0.05,
+    'page': 0.2,
+}
+SEARCH_WORDS = ['escola', 'abrigo', 'são joão', 'centro', 'rua 42', 'canoas', 'porto alegre', 'estadual']
+
+def seed_redis(client, size, seed):
+    # What a full refresh of get_api_data writes, for shelters shaped like its clean_data output
+    from get_api_data import SNAPSHOT_KEY, VERSION_KEY
+    from snapshot_format import encode_frame
+    client.set(SNAPSHOT_KEY, encode_frame(pd.DataFrame(make_shelters(size, seed)), 1))
+    client.set(VERSION_KEY, 1)
+    client.set('last_update', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+
+def use_fakeredis(size, seed):
+    # Every Redis client of the app talks to one server in this process
+    import fakeredis
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(lambda cls, *args, **kwargs: fakeredis.FakeRedis(server=server))
+    redis.from_url = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+    seed_redis(fakeredis.FakeRedis(server=server), size, seed)
+
+def find_callback(callback_map, output):
+    # Key of the callback writing output, multi-output keys look like "..map.figure...map-level.data.."
+    return next(key for key in callback_map if key == output or f'..{output}..' in key)
+
+def layout_values(layout):
+    # Initial value of every (id, property) the callbacks read, as the browser has them before the first callback
+    values = {}
+    for component in layout._traverse():
+        component_id = getattr(component, 'id', None)
+        if component_id is not None:
+            for prop in component._prop_names:
+                values[(component_id, prop)] = getattr(component, prop, None)
+    return values
+
+def callback_request(callback_map, output, values, changed):
+    callback = callback_map[output]
+    if output.startswith('..'):
+        outputs = [dict(zip(['id', 'property'], item.rsplit('.', 1))) for item in output[2:-2].split('...')]
+    else:
+        outputs = dict(zip(['id', 'property'], output.rsplit('.', 1)))
+    def arguments(items):
+        return [{'id': item['id'], 'property': item['property'], 'value': values.get((item['id'], item['property']))} for item in items]
+    return {'output': output, 'outputs': outputs, 'inputs': arguments(callback['inputs']), 'state': arguments(callback['state']), 'changedPropIds': changed}
+
+def call(user, output, changed, stats):
+    body = callback_request(user['callback_map'], output, user['values'], changed)
+    start = time.perf_counter()
+    response = user['client'].post('/_dash-update-component', json=body)
+    stats['latencies'].setdefault(user['names'][output], []).append(time.perf_counter() - start)
+    if response.status_code == 204:
+        stats['prevented'] += 1
+        return
+    if response.status_code != 200:
+        stats['errors'] += 1
+        return
+    for component_id, props in response.get_json()['response'].items():
+        for prop, value in props.items():
+            if not (isinstance(value, dict) and '__dash_patch_update' in value):
+                user['values'][(component_id, prop)] = value
+
+def render(user, changed, stats):
+    call(user, user['outputs']['filter'], changed, stats)
+    for output in user['outputs']['renders']:
+        call(user, output, [FILTER_OUTPUT], stats)
+
+def page_load(app, stats):
+    client = app.server.test_client()
+    client.get('/')
+    callback_map = app.app.callback_map
+    outputs = {
+        'filter': FILTER_OUTPUT,
+        'language': find_callback(callback_map, LANGUAGE_OUTPUT),
+        'page': TABLE_PAGE_OUTPUT,
+        'renders': [find_callback(callback_map, name) for name in RENDER_OUTPUTS],
+    }
+    names = {key: callback_map[key]['callback'].__name__ for key in callback_map}
+    user = {'client': client, 'callback_map': callback_map, 'values': layout_values(app.app.layout), 'outputs': outputs, 'names': names}
+    call(user, outputs['language'], ['pt-br.n_clicks'], stats)
+    render(user, ['search-filter.value'], stats)
+    return user
+
+def interact(user, rng, stats):
+    values = user['values']
+    kind = rng.choice(list(INTERACTIONS), p=list(INTERACTIONS.values()))
+    if kind == 'search':
+        # A request per keystroke, like the search input sends them
+        word = SEARCH_WORDS[rng.integers(len(SEARCH_WORDS))]
+        for end in range(1, len(word) + 1):
+            values[('search-filter', 'value')] = word[:end]
+            render(user, ['search-filter.value'], stats)
+        return
+    if kind == 'page':
+        values[('shelter-table', 'page_current')] = int(rng.integers(0, 5))
+        call(user, user['outputs']['page'], ['shelter-table.page_current'], stats)
+        return
+    if kind == 'language':
+        clicked = 'en' if rng.random() < 0.5 else 'pt-br'
+        values[(clicked, 'n_clicks')] = (values.get((clicked, 'n_clicks')) or 0) + 1
+        call(user, user['outputs']['language'], [f'{clicked}.n_clicks'], stats)
+        render(user, [f'{clicked}.n_clicks'], stats)
+        return
+    options = {
+        'city': ('city-filter', list(rng.choice(list(CITIES), size=int(rng.integers(1, 3)), replace=False))),
+        'availability': ('availability-filter', sorted(int(status) for status in rng.choice([1, 2, 3, 4], size=int(rng.integers(1, 4)), replace=False))),
+        'verified': ('verification-filter', bool(rng.random() < 0.5)),
+        'pet': ('pet-filter', bool(rng.random() < 0.5)),
+        'distance': ('distance-filter', ['km:5', 'km:25', 'nearest:10'][rng.integers(3)]),
+    }
+    component_id, value = options[kind]
+    values[(component_id, 'value')] = value
+    render(user, [f'{component_id}.value'], stats)
+
+def run_level(app, concurrency, interactions, seed):
+    stats = {'latencies': {}, 'prevented': 0, 'errors': 0}
+    stats_lock = threading.Lock()
+    def simulate(user_index):
+        rng = np.random.default_rng([seed, concurrency, user_index])
+        user_stats = {'latencies': {}, 'prevented': 0, 'errors': 0}
+        user = page_load(app, user_stats)
+        for _ in range(interactions // concurrency):
+            interact(user, rng, user_stats)
+        with stats_lock:
+            for name, latencies in user_stats['latencies'].items():
+                stats['latencies'].setdefault(name, []).extend(latencies)
+            stats['prevented'] += user_stats['prevented']
+            stats['errors'] += user_stats['errors']
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(simulate, range(concurrency)))
+    stats['seconds'] = time.perf_counter() - start
+    stats['page_loads'] = concurrency
+    stats['interactions'] = concurrency * (interactions // concurrency)
+    stats['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stats
+
+def run_worker(size, levels, interactions, seed, redis_url, snapshot_dir, barrier, results):
+    os.environ['SNAPSHOT_DIR'] = snapshot_dir
+    if redis_url:
+        os.environ['REDIS_URL'] = redis_url
+    else:
+        use_fakeredis(size, seed)
+    import app
+    # The first page load builds or maps the snapshot, it is not measured
+    page_load(app, {'latencies': {}, 'prevented': 0, 'errors': 0})
+    worker_results = []
+    for concurrency in levels:
+        barrier.wait()
+        worker_results.append(run_level(app, concurrency, interactions, seed))
+    results.put(worker_results)
+
+def percentiles(latencies):
+    values = np.array(latencies) * 1000
+    return {'count': len(values), **{f'p{q}': round(float(np.percentile(values, q)), 2) for q in [50, 95, 99]}}
+
+def summarize(size, concurrency, workers, worker_stats):
+    latencies = {}
+    for stats in worker_stats:
+        for name, values in stats['latencies'].items():
+            latencies.setdefault(name, []).extend(values)
+    seconds = max(stats['seconds'] for stats in worker_stats)
+    callbacks = sum(len(values) for values in latencies.values())
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'workers': workers,
+        'seconds': round(seconds, 3),
+        'interactions': sum(stats['interactions'] for stats in worker_stats),
+        'interactions_per_second': round(sum(stats['interactions'] for stats in worker_stats) / seconds, 2),
+        'callbacks_per_second': round(callbacks / seconds, 2),
+        'prevented': sum(stats['prevented'] for stats in worker_stats),
+        'errors': sum(stats['errors'] for stats in worker_stats),
+        'peak_rss_kb': [stats['peak_rss_kb'] for stats in worker_stats],
+        'latency_ms': {name: percentiles(values) for name, values in sorted(latencies.items())},
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_run(run):
+    print(f"\n{run['size']} rows, {run['workers']} worker(s) x {run['concurrency']} users: {run['interactions_per_second']} interactions/s, "
+          f"{run['callbacks_per_second']} callbacks/s, peak RSS {', '.join(f'{rss // 1024} MB' for rss in run['peak_rss_kb'])}, "
+          f"{run['prevented']} prevented, {run['errors']} errors")
+    print(f"{'callback':<26} {'count':>7} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for name, latency in run['latency_ms'].items():
+        print(f"{name:<26} {latency['count']:>7} {latency['p50']:>9.2f} {latency['p95']:>9.2f} {latency['p99']:>9.2f}")
+
+def compare(previous, runs):
+    # Change of p50/p95 per callback against the runs of an earlier result file with the same size and load
+    earlier = {(run['size'], run['concurrency'], run['workers']): run for run in previous['runs']}
+    print(f"\nAgainst {previous.get('git_commit')} ({previous.get('started_at')})")
+    print(f"{'rows':>8} {'users':>6} {'callback':<26} {'p50':>8} {'p95':>8}")
+    for run in runs:
+        before = earlier.get((run['size'], run['concurrency'], run['workers']))
+        if before is None:
+            continue
+        for name, latency in run['latency_ms'].items():
+            if name in before['latency_ms']:
+                old = before['latency_ms'][name]
+                print(f"{run['size']:>8} {run['concurrency']:>6} {name:<26} {latency['p50'] / old['p50'] - 1:>+8.0%} {latency['p95'] / old['p95'] - 1:>+8.0%}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--interactions', type=int, default=200, help='interactions per worker and concurrency level')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redis-url')
+    parser.add_argument('--output', default='bench_callbacks.json')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    report = {
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'redis': 'url' if args.redis_url else 'fakeredis',
+        'args': vars(args),
+        'runs': [],
+    }
+    context = multiprocessing.get_context('spawn')
+    # The workers of a run share one snapshot file, like the workers of a gunicorn server
+    os.environ['SNAPSHOT_RUN_ID'] = f'bench-{os.getpid()}'
+    for size in args.sizes:
+        if args.redis_url:
+            seed_redis(redis.Redis.from_url(args.redis_url), size, args.seed)
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            barrier = context.Barrier(args.workers)
+            results = context.Queue()
+            processes = [
+                context.Process(target=run_worker, args=(size, args.concurrency, args.interactions, args.seed, args.redis_url, snapshot_dir, barrier, results))
+                for _ in range(args.workers)
+            ]
+            for process in processes:
+                process.start()
+            worker_results = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+        for level, concurrency in enumerate(args.concurrency):
+            run = summarize(size, concurrency, args.workers, [stats[level] for stats in worker_results])
+            report['runs'].append(run)
+            print_run(run)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report['runs'])
+
+if __name__ == '__main__':
+    main()
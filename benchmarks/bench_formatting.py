@@ -0,0 +1,77 @@
+# Compares the row-wise formatting that get_formated_data used to run with snapshot.format_data + format_display.
+# Usage: python -m benchmarks.bench_formatting [--sizes 5000 50000 500000] [--repeat 3]
+import argparse
+import time
+import pandas as pd
+from benchmarks.synthetic import make_shelters
+from snapshot import AVAILABILITY_STATUS_IDS, format_data, format_display
+
+DISPLAY_COLUMNS = ['id', 'link', 'capacity_info', 'vacancies', 'updatedAt', 'availability']
+
+def legacy_map_availability(row):
+    if pd.isnull(row['capacity']) or pd.isnull(row['shelteredPeople']):
+        status = 'Check'
+    elif row['shelteredPeople'] > row['capacity']:
+        status = 'Full'
+    elif row['shelteredPeople'] == row['capacity']:
+        status = 'Crowded'
+    else:
+        status = 'Available'
+    return AVAILABILITY_STATUS_IDS[status]
+
+def legacy_create_link(row):
+    icons = f"{row['pet_icon']}"
+    return f"{icons} [{row['name']}](https://sos-rs.com/abrigo/{row['id']})"
+
+def legacy_format_date(data_original):
+    data_datetime = pd.to_datetime(data_original)
+    return data_datetime.strftime("%d/%m/%Y %H:%M:%S")
+
+def legacy_calculate_vacancies(row):
+    if row['capacity'] >= 0 and row['shelteredPeople'] >= 0:
+        return row['capacity'] - row['shelteredPeople']
+    else:
+        return "-"
+
+def legacy_format_data(df):
+    df['pet_icon'] = df['petFriendly'].apply(lambda x: '🐾' if x else '')
+    df['verification_icon'] = df['verified'].apply(lambda x: '✔️' if x else '❌')
+    df['capacity_info'] = df.apply(lambda row: f"{int(row['shelteredPeople']) if pd.notnull(row['shelteredPeople']) else '-'}/{int(row['capacity']) if pd.notnull(row['capacity']) else '-'}", axis=1)
+    df['vacancies'] = df.apply(legacy_calculate_vacancies, axis=1)
+    df['link'] = df.apply(legacy_create_link, axis=1)
+    df['updatedAt'] = df['updatedAt'].apply(legacy_format_date)
+    df = df.sort_values(by='updatedAt', ascending=False)
+    df['availability'] = df.apply(legacy_map_availability, axis=1)
+    return df
+
+def best_time(function, raw, repeat):
+    timings = []
+    for _ in range(repeat):
+        df = raw.copy()
+        start = time.perf_counter()
+        result = function(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+    for size in args.sizes:
+        raw = pd.json_normalize(make_shelters(size))
+        # Missing petFriendly values come back from Redis as None, not NaN
+        raw['petFriendly'] = raw['petFriendly'].astype(object).where(raw['petFriendly'].notna(), None)
+        legacy_time, legacy = best_time(legacy_format_data, raw, args.repeat)
+        vectorized_time, vectorized = best_time(format_data, raw, args.repeat)
+        # Both pipelines must agree on every displayed column; the legacy one sorted by the formatted date
+        # text (day first), so rows are compared by id
+        legacy = legacy[DISPLAY_COLUMNS].sort_values('id', ignore_index=True)
+        vectorized = format_display(vectorized)[DISPLAY_COLUMNS].sort_values('id', ignore_index=True)
+        pd.testing.assert_frame_equal(legacy, vectorized, check_dtype=False)
+        print(f"{size:>8} {legacy_time:>12.3f} {vectorized_time:>15.3f} {legacy_time / vectorized_time:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
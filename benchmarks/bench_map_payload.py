@@ -0,0 +1,59 @@
+# JSON size of the map traces sent to the browser: every shelter as a point (what update_data sent) vs the
+# clustered levels of map_lod, and the points in view once zoomed in past MAP_CLUSTER_MAX_ZOOM.
+# Usage: python -m benchmarks.bench_map_payload [--sizes 5000 50000 500000] [--zooms 5 7 9 11]
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.express as px
+from benchmarks.synthetic import make_shelters
+from geo import build_cluster_index
+from map_lod import cluster_traces, in_view
+from snapshot import AVAILABILITY_STATUS_IDS, format_data
+
+COLORS = {1: '#2ECC40', 2: '#00BFFF', 3: '#FFB347', 4: '#FF6347'}
+STATUS_STYLES = {status_id: {'name': name, 'color': COLORS[status_id]} for name, status_id in AVAILABILITY_STATUS_IDS.items()}
+# About what the map shows of Porto Alegre at zoom 13
+VIEW_BOUNDS = (-51.30, -30.08, -51.15, -29.98)
+
+def payload_size(traces):
+    return len(json.dumps(traces, cls=plotly.utils.PlotlyJSONEncoder))
+
+def point_traces(df):
+    hover_columns = ['city', 'capacity', 'shelteredPeople', 'availabilityDescription']
+    map_df = df[['latitude', 'longitude', 'name', 'city', 'capacity', 'shelteredPeople']].assign(
+        availabilityDescription=df['availability'].map({status_id: style['name'] for status_id, style in STATUS_STYLES.items()}))
+    map_df[hover_columns] = map_df[hover_columns].astype(object).where(map_df[hover_columns].notna(), "")
+    return px.scatter_mapbox(map_df, lat='latitude', lon='longitude', hover_name='name', hover_data=hover_columns, color='availabilityDescription').to_plotly_json()['data']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--zooms', type=int, nargs='+', default=[5, 7, 9, 11])
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'map':>16} {'payload (KB)':>13} {'markers':>8} {'build (ms)':>11}")
+    for size in args.sizes:
+        df = format_data(pd.json_normalize(make_shelters(size)))
+        latitudes = df['latitude'].to_numpy(dtype='float64', na_value=np.nan)
+        longitudes = df['longitude'].to_numpy(dtype='float64', na_value=np.nan)
+        clusters = build_cluster_index(latitudes, longitudes)
+
+        start = time.perf_counter()
+        points = point_traces(df)
+        rows = [('all points', points, time.perf_counter() - start)]
+        for zoom in args.zooms:
+            start = time.perf_counter()
+            traces = cluster_traces(clusters[zoom], latitudes, longitudes, df['availability'].to_numpy(), STATUS_STYLES, 'shelters')
+            rows.append((f'zoom {zoom} clusters', traces, time.perf_counter() - start))
+        start = time.perf_counter()
+        rows.append(('points in view', point_traces(df[in_view(latitudes, longitudes, VIEW_BOUNDS)]), time.perf_counter() - start))
+
+        for name, traces, seconds in rows:
+            markers = sum(len(trace['lat']) for trace in traces)
+            print(f"{size:>8} {name:>16} {payload_size(traces) / 1024:>13.1f} {markers:>8} {seconds * 1000:>11.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Bytes per column of the shelters snapshot, with the object/float64 layout it used to have and with the
+# typed one from snapshot.format_data, and what that adds up to across the gunicorn workers.
+# Usage: python -m benchmarks.bench_memory [--size 50000] [--workers 4]
+import argparse
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import make_shelters
+from snapshot import AVAILABILITY_STATUS_IDS, build_search_index, format_count, format_data, get_memory_report
+
+def object_layout(df):
+    # The snapshot before explicit dtypes: float64 counts and coordinates, every display string stored per shelter
+    capacity = df['capacity']
+    sheltered = df['shelteredPeople']
+    df['pet_icon'] = np.where(df['petFriendly'].astype(bool), '🐾', '')
+    df['verification_icon'] = np.where(df['verified'].astype(bool), '✔️', '❌')
+    df['capacity_info'] = format_count(sheltered) + '/' + format_count(capacity)
+    df['vacancies'] = (capacity - sheltered).astype(object).where((capacity >= 0) & (sheltered >= 0), '-')
+    df['link'] = df['pet_icon'] + ' [' + df['name'].astype(str) + '](https://sos-rs.com/abrigo/' + df['id'].astype(str) + ')'
+    df['updatedAt'] = pd.to_datetime(df['updatedAt'], format='ISO8601').dt.strftime('%d/%m/%Y %H:%M:%S')
+    df['availability'] = np.select(
+        [capacity.isna() | sheltered.isna(), sheltered > capacity, sheltered == capacity],
+        [AVAILABILITY_STATUS_IDS['Check'], AVAILABILITY_STATUS_IDS['Full'], AVAILABILITY_STATUS_IDS['Crowded']],
+        default=AVAILABILITY_STATUS_IDS['Available']
+    )
+    df['search_text'] = build_search_index(df)
+    df['city'] = df['city'].astype('category')
+    return df
+
+def typed_layout(df):
+    df = format_data(df)
+    df['search_text'] = build_search_index(df)
+    return df
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    raw = pd.json_normalize(make_shelters(args.size))
+    before = get_memory_report(object_layout(raw.copy()))
+    after = get_memory_report(typed_layout(raw.copy()))
+
+    print(f"{'column':<20} {'before':>32} {'after':>32}")
+    for column in sorted(set(before['columns']) | set(after['columns'])):
+        cells = []
+        for report in [before, after]:
+            info = report['columns'].get(column)
+            cells.append(f"{info['bytes']:>12,} {info['dtype']:>19}" if info else f"{'-':>32}")
+        print(f"{column:<20} {cells[0]} {cells[1]}")
+
+    print(f"{'per worker':<20} {before['total_bytes']:>12,} {'':>19} {after['total_bytes']:>12,}")
+    print(f"{f'{args.workers} workers':<20} {before['total_bytes'] * args.workers:>12,} {'':>19} {after['total_bytes'] * args.workers:>12,}")
+    print(f"{args.size} rows, {after['total_bytes'] / before['total_bytes']:.0%} of the previous size")
+
+if __name__ == '__main__':
+    main()
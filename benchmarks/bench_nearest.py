@@ -0,0 +1,56 @@
+# Nearest-k and radius queries around random points of Rio Grande do Sul: distance to every shelter and a
+# sort (what update_data did) vs the grid index of geo.py. Both must return the same shelters.
+# Usage: python -m benchmarks.bench_nearest [--sizes 5000 50000 500000] [--queries 200] [--k 10] [--radius 10]
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import CITIES, make_shelters
+from geo import build_grid_index, haversine_km, nearest, within_radius
+
+def scan_nearest(latitudes, longitudes, lat, lon, k):
+    distances = haversine_km(latitudes, longitudes, lat, lon)
+    return np.argsort(np.where(np.isnan(distances), np.inf, distances), kind='stable')[:k]
+
+def scan_radius(latitudes, longitudes, lat, lon, radius_km):
+    return np.flatnonzero(haversine_km(latitudes, longitudes, lat, lon) <= radius_km)
+
+def timed_queries(function, points):
+    start = time.perf_counter()
+    results = [function(lat, lon) for lat, lon in points]
+    return (time.perf_counter() - start) / len(points), results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--radius', type=float, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    centers = np.array(list(CITIES.values()))[rng.integers(0, len(CITIES), args.queries)]
+    points = [(lat, lon) for lat, lon in centers + rng.normal(0, 0.1, centers.shape)]
+
+    print(f"{'rows':>8} {'index build (ms)':>17} {'nearest scan/index (ms)':>24} {'radius scan/index (ms)':>23}")
+    for size in args.sizes:
+        df = pd.json_normalize(make_shelters(size))
+        latitudes = df['latitude'].to_numpy(dtype='float32', na_value=np.nan)
+        longitudes = df['longitude'].to_numpy(dtype='float32', na_value=np.nan)
+        start = time.perf_counter()
+        index = build_grid_index(latitudes, longitudes)
+        build_time = time.perf_counter() - start
+
+        scan_k, expected = timed_queries(lambda lat, lon: scan_nearest(latitudes, longitudes, lat, lon, args.k), points)
+        index_k, found = timed_queries(lambda lat, lon: nearest(index, lat, lon, args.k)[0], points)
+        # Ties at the same distance may come in another order
+        assert all(set(a) == set(b) for a, b in zip(expected, found))
+
+        scan_r, expected = timed_queries(lambda lat, lon: scan_radius(latitudes, longitudes, lat, lon, args.radius), points)
+        index_r, found = timed_queries(lambda lat, lon: within_radius(index, lat, lon, args.radius)[0], points)
+        assert all(set(a) == set(b) for a, b in zip(expected, found))
+
+        print(f"{size:>8} {build_time * 1000:>17.1f} {scan_k * 1000:>12.2f} / {index_k * 1000:>9.3f} {scan_r * 1000:>11.2f} / {index_r * 1000:>9.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Response of a filter change for the map and the pie: the whole plotly express figures update_data used to
+# send vs the dash Patch of figures.py with only their traces. Time is building and JSON encoding the output.
+# Usage: python -m benchmarks.bench_patch [--sizes 500 5000 50000] [--repeat 5]
+import argparse
+import json
+import time
+import pandas as pd
+import plotly
+import plotly.express as px
+from benchmarks.synthetic import make_shelters
+from figures import map_patch, pie_patch, point_traces
+from map_lod import MAP_ZOOM
+from snapshot import AVAILABILITY_STATUS_IDS, format_data
+
+COLORS = {1: '#2ECC40', 2: '#00BFFF', 3: '#FFB347', 4: '#FF6347'}
+STATUS_STYLES = {status_id: {'name': name, 'color': COLORS[status_id]} for name, status_id in AVAILABILITY_STATUS_IDS.items()}
+COLOR_MAP = {style['name']: style['color'] for style in STATUS_STYLES.values()}
+LABELS = {'city': 'City', 'capacity': 'Capacity', 'shelteredPeople': 'People Sheltered', 'availability': 'Availability'}
+CENTER = {'lat': -30.033056, 'lon': -51.230000}
+
+def response_bytes(output):
+    return len(json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder))
+
+def full_map(df):
+    hover_columns = ['city', 'capacity', 'shelteredPeople', 'availabilityDescription']
+    map_df = df[['latitude', 'longitude', 'name', 'city', 'capacity', 'shelteredPeople']].assign(
+        availabilityDescription=df['availability'].map({status_id: style['name'] for status_id, style in STATUS_STYLES.items()}))
+    map_df[hover_columns] = map_df[hover_columns].astype(object).where(map_df[hover_columns].notna(), "")
+    fig = px.scatter_mapbox(map_df, lat='latitude', lon='longitude', hover_name='name', hover_data=hover_columns,
+                            color='availabilityDescription', color_discrete_map=COLOR_MAP, zoom=MAP_ZOOM)
+    fig.update_traces(marker=dict(size=12))
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, paper_bgcolor='#0E0F0E', mapbox_style='carto-darkmatter',
+                      mapbox_center=CENTER, uirevision='map',
+                      legend=dict(x=0, y=1, title_font_family="Times New Roman", font=dict(family="Courier", size=12, color='white'), title_text=""))
+    return fig.to_plotly_json()
+
+def patched_map(df):
+    return map_patch(point_traces(df, STATUS_STYLES, LABELS), CENTER).to_plotly_json()
+
+def full_pie(df):
+    counts = df['availability'].map({status_id: style['name'] for status_id, style in STATUS_STYLES.items()}).value_counts().reset_index()
+    counts.columns = ['availabilityDescription', 'count']
+    fig = px.pie(counts, names='availabilityDescription', values='count', hole=0.25, color='availabilityDescription', color_discrete_map=COLOR_MAP)
+    fig.update_layout(title_font_color='white', font_color='white', paper_bgcolor='#0E0F0E', plot_bgcolor='white')
+    fig.update_traces(hovertemplate='%{label}: %{value} <extra></extra>')
+    return fig.to_plotly_json()
+
+def patched_pie(df):
+    counts = df['availability'].value_counts()
+    return pie_patch([STATUS_STYLES[status_id]['name'] for status_id in counts.index], counts.tolist(),
+                     [STATUS_STYLES[status_id]['color'] for status_id in counts.index]).to_plotly_json()
+
+def measure(build, df, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = response_bytes(build(df))
+        best = min(best, time.perf_counter() - start)
+    return size, best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 5000, 50000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'output':>12} {'full (KB)':>10} {'patch (KB)':>11} {'full (ms)':>10} {'patch (ms)':>11}")
+    for size in args.sizes:
+        df = format_data(pd.json_normalize(make_shelters(size)))
+        for name, full, patched in [('map', full_map, patched_map), ('pie', full_pie, patched_pie)]:
+            full_size, full_time = measure(full, df, args.repeat)
+            patch_size, patch_time = measure(patched, df, args.repeat)
+            print(f"{size:>8} {name:>12} {full_size / 1024:>10.1f} {patch_size / 1024:>11.1f} {full_time * 1000:>10.1f} {patch_time * 1000:>11.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Per-keystroke latency of the search box: row-wise scan of every column vs the snapshot search index,
+# searched in the shared snapshot buffer.
+# Usage: python -m benchmarks.bench_search [--sizes 5000 50000 500000] [--query "escola sao joao"]
+import argparse
+import time
+import pandas as pd
+from benchmarks.synthetic import make_shelters
+from snapshot import build_search_index, format_data, read_snapshot, search_mask
+from snapshot_format import encode_shared_frame
+
+def legacy_search(df, search):
+    search = search.lower()
+    return df[df.apply(lambda row: row.astype(str).str.lower().str.contains(search).any(), axis=1)]
+
+def index_search(snapshot, search):
+    return snapshot['df'][search_mask(snapshot, search)]
+
+def keystroke_latency(function, df, query):
+    # Every prefix of the query is one keystroke in the search box
+    timings = []
+    for end in range(1, len(query) + 1):
+        start = time.perf_counter()
+        result = function(df, query[:end])
+        timings.append(time.perf_counter() - start)
+    return sum(timings) / len(timings), len(result)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    parser.add_argument('--query', default='porto alegre')
+    parser.add_argument('--skip-legacy', action='store_true', help='the row-wise scan takes minutes at 500k rows')
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'build (s)':>10} {'legacy (ms/key)':>16} {'index (ms/key)':>15} {'matches':>15}")
+    for size in args.sizes:
+        df = format_data(pd.json_normalize(make_shelters(size)))
+        start = time.perf_counter()
+        df['search_text'] = build_search_index(df)
+        df['city'] = df['city'].astype('category')
+        snapshot = read_snapshot(encode_shared_frame(df, None))
+        build_time = time.perf_counter() - start
+
+        index_latency, index_matches = keystroke_latency(index_search, snapshot, args.query)
+        if args.skip_legacy:
+            legacy_column, matches = f"{'-':>16}", f"{index_matches}"
+        else:
+            legacy_latency, legacy_matches = keystroke_latency(legacy_search, df.drop(columns='search_text'), args.query)
+            legacy_column, matches = f"{legacy_latency * 1000:>16.1f}", f"{legacy_matches}/{index_matches}"
+        print(f"{size:>8} {build_time:>10.3f} {legacy_column} {index_latency * 1000:>15.2f} {matches:>15}")
+
+if __name__ == '__main__':
+    main()
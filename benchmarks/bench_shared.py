@@ -0,0 +1,79 @@
+# Per-worker cost of getting a new snapshot: each worker formatting its own copy vs mapping the shared
+# snapshot file written once for the host. Memory is the private bytes each worker adds (Linux only).
+# Usage: python -m benchmarks.bench_shared [--size 50000] [--workers 4]
+import argparse
+import mmap
+import multiprocessing
+import os
+import tempfile
+import time
+import pandas as pd
+from benchmarks.synthetic import make_shelters
+from snapshot import build_search_index, format_data, get_frame, read_snapshot, search_mask
+from snapshot_format import encode_shared_frame
+
+def private_bytes():
+    # Private_Clean + Private_Dirty of this process; pages of a shared mapping are not counted
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            fields = dict(line.split(':', 1) for line in file if ':' in line)
+    except OSError:
+        return 0
+    return sum(int(fields[name].split()[0]) * 1024 for name in ['Private_Clean', 'Private_Dirty'])
+
+def use(snapshot):
+    # Touches what a callback touches: a search over every shelter and one filtered frame
+    return len(get_frame(snapshot, search_mask(snapshot, 'escola').nonzero()[0][:100]))
+
+def format_worker(raw, results):
+    before = private_bytes()
+    start = time.perf_counter()
+    df = format_data(raw.copy())
+    df['search_text'] = build_search_index(df)
+    df['city'] = df['city'].astype('category')
+    len(df.take(df['search_text'].str.contains('escola', regex=False).to_numpy().nonzero()[0][:100]))
+    results.put((time.perf_counter() - start, private_bytes() - before))
+
+def map_worker(path, results):
+    before = private_bytes()
+    start = time.perf_counter()
+    with open(path, 'rb') as file:
+        snapshot = read_snapshot(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    use(snapshot)
+    results.put((time.perf_counter() - start, private_bytes() - before))
+
+def run_workers(target, argument, workers):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=(argument, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measures = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return max(seconds for seconds, _ in measures), sum(size for _, size in measures)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    raw = pd.json_normalize(make_shelters(args.size))
+    df = format_data(raw.copy())
+    df['search_text'] = build_search_index(df)
+    df['city'] = df['city'].astype('category')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'shelters.snapshot')
+        start = time.perf_counter()
+        with open(path, 'wb') as file:
+            file.write(encode_shared_frame(df, None))
+        write_time = time.perf_counter() - start
+
+        print(f"{args.size} rows, {args.workers} workers, snapshot file {os.path.getsize(path):,} bytes written in {write_time:.3f}s")
+        print(f"{'':<24} {'reload (s)':>11} {'private bytes, all workers':>28}")
+        for name, target, argument in [('each worker formats', format_worker, raw), ('workers map the file', map_worker, path)]:
+            seconds, size = run_workers(target, argument, args.workers)
+            print(f"{name:<24} {seconds:>11.3f} {size:>28,}")
+
+if __name__ == '__main__':
+    main()
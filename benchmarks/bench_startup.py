@@ -0,0 +1,44 @@
+# Worker startup: time to import app and time to the first responses, with the snapshot built at import
+# (APP_STARTUP=eager) and on first use (APP_STARTUP=lazy). Each run is a fresh process with its own snapshot
+# directory, against the shelters already stored in the Redis at REDIS_URL.
+# Usage: python -m benchmarks.bench_startup [--runs 3]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+WORKER = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.server.test_client()
+client.get('/')
+page = time.perf_counter()
+client.get('/api/shelters/nearest?lat=-30.03&lon=-51.23')
+data = time.perf_counter()
+print(json.dumps({'import': imported - start, 'page': page - start, 'data': data - start}))
+'''
+
+def run_worker(startup):
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'APP_STARTUP': startup, 'SNAPSHOT_DIR': directory}
+        output = subprocess.run([sys.executable, '-c', WORKER], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'startup':<8} {'import app (s)':>15} {'first page (s)':>15} {'first data (s)':>15}")
+    for startup in ['eager', 'lazy']:
+        runs = [run_worker(startup) for _ in range(args.runs)]
+        medians = {name: statistics.median(run[name] for run in runs) for name in ['import', 'page', 'data']}
+        print(f"{startup:<8} {medians['import']:>15.3f} {medians['page']:>15.3f} {medians['data']:>15.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Size, Redis transfer and decode-to-DataFrame time of the JSON and binary shelters snapshots.
+# Redis transfer is measured against REDIS_URL when it is reachable.
+# Usage: python -m benchmarks.bench_storage [--sizes 5000 50000 500000]
+import argparse
+import json
+import os
+import time
+import pandas as pd
+import redis
+import snapshot_format
+from benchmarks.synthetic import make_shelters
+from snapshot_format import decode_frame, encode_frame
+
+BENCH_KEY = 'bench:shelters_snapshot'
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def redis_round_trip(client, payload):
+    if client is None:
+        return None
+    start = time.perf_counter()
+    client.set(BENCH_KEY, payload)
+    client.get(BENCH_KEY)
+    elapsed = time.perf_counter() - start
+    client.delete(BENCH_KEY)
+    return elapsed
+
+def connect():
+    client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    try:
+        client.ping()
+        return client
+    except redis.ConnectionError:
+        return None
+
+def encode_json(df):
+    return df.to_json(orient='records')
+
+def decode_json(payload):
+    return pd.json_normalize(json.loads(payload))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000, 500000])
+    args = parser.parse_args()
+    client = connect()
+
+    formats = [('json', None), ('msgpack', 'none')]
+    if snapshot_format.zstandard is not None:
+        formats.append(('msgpack+zstd', 'zstd'))
+
+    print(f"{'rows':>8} {'format':>13} {'size (KB)':>10} {'encode (ms)':>12} {'redis set+get (ms)':>19} {'decode (ms)':>12}")
+    for size in args.sizes:
+        df = pd.json_normalize(make_shelters(size))
+        for name, compression in formats:
+            if compression is None:
+                encode_time, payload = timed(encode_json, df)
+                decode_time, _ = timed(decode_json, payload)
+                payload = payload.encode('utf-8')
+            else:
+                snapshot_format.SNAPSHOT_COMPRESSION = compression
+                encode_time, payload = timed(encode_frame, df, 1)
+                decode_time, _ = timed(decode_frame, payload)
+            transfer_time = redis_round_trip(client, payload)
+            transfer = f"{transfer_time * 1000:>19.1f}" if transfer_time is not None else f"{'-':>19}"
+            print(f"{size:>8} {name:>13} {len(payload) / 1024:>10.0f} {encode_time * 1000:>12.1f} {transfer} {decode_time * 1000:>12.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import numpy as np
+
+# Cities of Rio Grande do Sul with their approximate center (lat, lon)
+CITIES = {
+    'Porto Alegre': (-30.0331, -51.2300),
+    'Canoas': (-29.9178, -51.1839),
+    'São Leopoldo': (-29.7604, -51.1472),
+    'Novo Hamburgo': (-29.6783, -51.1309),
+    'Gravataí': (-29.9441, -50.9919),
+    'Eldorado do Sul': (-30.0847, -51.6187),
+    'Guaíba': (-30.1136, -51.3250),
+    'Caxias do Sul': (-29.1678, -51.1794),
+    'Santa Maria': (-29.6842, -53.8069),
+    'Pelotas': (-31.7654, -52.3376),
+}
+
+def make_shelters(n, seed=0):
+    # Records shaped like get_api_data.clean_data output, None values already stripped
+    rng = np.random.default_rng(seed)
+    city_names = list(CITIES)
+    city_idx = rng.integers(0, len(city_names), n)
+    centers = np.array([CITIES[name] for name in city_names])[city_idx]
+    latitude = centers[:, 0] + rng.normal(0, 0.05, n)
+    longitude = centers[:, 1] + rng.normal(0, 0.05, n)
+    capacity = rng.integers(0, 400, n)
+    sheltered = rng.integers(0, 450, n)
+    # Some shelters report the exact capacity, so every availability status shows up
+    sheltered = np.where(rng.random(n) < 0.1, capacity, sheltered)
+    missing_capacity = rng.random(n) < 0.2
+    missing_sheltered = rng.random(n) < 0.15
+    missing_location = rng.random(n) < 0.05
+    missing_city = rng.random(n) < 0.01
+    pet_friendly = rng.choice([True, False, None], n, p=[0.3, 0.6, 0.1])
+    verified = rng.random(n) < 0.5
+    seconds = rng.integers(0, 30 * 24 * 3600, n)
+    updated_at = (np.datetime64('2024-05-01T00:00:00', 's') + seconds.astype('timedelta64[s]')).astype(str)
+
+    shelters = []
+    for i in range(n):
+        shelter = {
+            'id': f'{i:08x}-0000-4000-8000-{seed:012x}',
+            'name': f'Abrigo {i} - Escola Estadual São João',
+            'address': f'Rua {i % 997}, {city_idx[i] * 10 + 1} - Centro',
+            'city': None if missing_city[i] else city_names[city_idx[i]],
+            'petFriendly': pet_friendly[i],
+            'verified': bool(verified[i]),
+            'capacity': None if missing_capacity[i] else int(capacity[i]),
+            'shelteredPeople': None if missing_sheltered[i] else int(sheltered[i]),
+            'latitude': None if missing_location[i] else float(latitude[i]),
+            'longitude': None if missing_location[i] else float(longitude[i]),
+            'updatedAt': f'{updated_at[i]}.000Z',
+        }
+        shelters.append({k: v for k, v in shelter.items() if v is not None})
+    return shelters
@@ -0,0 +1,95 @@
+import numpy as np
+from dash import Patch
+
+# Map and pie figures of the dashboard: their layout is built once with the page, the callbacks only send
+# the traces that change, as a dash Patch
+
+MAP_CENTER = {'lat': -30.033056, 'lon': -51.230000}
+
+def base_map_figure(background_color, font_color, map_style, zoom):
+    return {
+        'data': [],
+        'layout': {
+            'margin': {'r': 0, 't': 0, 'l': 0, 'b': 0},
+            'paper_bgcolor': background_color,
+            'mapbox': {'style': map_style, 'center': MAP_CENTER, 'zoom': zoom},
+            'legend': {
+                'x': 0,
+                'y': 1,
+                'title': {'text': '', 'font': {'family': 'Times New Roman'}},
+                'font': {'family': 'Courier', 'size': 12, 'color': font_color},
+            },
+            # Keeps the zoom and position the user chose when the traces change
+            'uirevision': 'map',
+        },
+    }
+
+def base_pie_figure(background_color, font_color):
+    return {
+        'data': [{
+            'type': 'pie',
+            'hole': 0.25,
+            'labels': [],
+            'values': [],
+            'marker': {'colors': []},
+            'hovertemplate': '%{label}: %{value} <extra></extra>',
+        }],
+        'layout': {
+            'title': {'font': {'color': font_color}},
+            'font': {'color': font_color},
+            'paper_bgcolor': background_color,
+            'plot_bgcolor': font_color,
+        },
+    }
+
+def text_values(values):
+    # Hover values, with '' for missing ones
+    return values.astype(object).where(values.notna(), '').to_numpy()
+
+def point_traces(df, status_styles, labels, statuses=None):
+    # One scattermapbox trace per availability, like px.scatter_mapbox colored by availability.
+    # status_styles maps a statusId to its {'name', 'color'}, labels names the hover fields. statuses are the
+    # availabilities given a trace, even an empty one, so the legend does not change with the view; those in df when None
+    availability = df['availability'].to_numpy()
+    latitudes = df['latitude'].to_numpy(dtype='float64', na_value=np.nan).round(5)
+    longitudes = df['longitude'].to_numpy(dtype='float64', na_value=np.nan).round(5)
+    names = text_values(df['name'])
+    customdata = np.column_stack([text_values(df['city']), text_values(df['capacity']), text_values(df['shelteredPeople'])])
+
+    traces = []
+    for status_id, style in status_styles.items():
+        selected = availability == status_id
+        if not (selected.any() if statuses is None else status_id in statuses):
+            continue
+        traces.append({
+            'type': 'scattermapbox',
+            'subplot': 'mapbox',
+            'mode': 'markers',
+            'lat': latitudes[selected],
+            'lon': longitudes[selected],
+            'hovertext': names[selected],
+            'customdata': customdata[selected],
+            'hovertemplate': (
+                f"<b>%{{hovertext}}</b><br><br>{labels['availability']}={style['name']}<br>Latitude=%{{lat}}<br>Longitude=%{{lon}}"
+                f"<br>{labels['city']}=%{{customdata[0]}}<br>{labels['capacity']}=%{{customdata[1]}}"
+                f"<br>{labels['shelteredPeople']}=%{{customdata[2]}}<extra></extra>"
+            ),
+            'marker': {'color': style['color'], 'size': 12},
+            'name': style['name'],
+            'legendgroup': style['name'],
+            'showlegend': True,
+        })
+    return traces
+
+def map_patch(traces, center):
+    patch = Patch()
+    patch['data'] = traces
+    patch['layout']['mapbox']['center'] = center
+    return patch
+
+def pie_patch(labels, values, colors):
+    patch = Patch()
+    patch['data'][0]['labels'] = labels
+    patch['data'][0]['values'] = values
+    patch['data'][0]['marker']['colors'] = colors
+    return patch
@@ -0,0 +1,110 @@
+import os
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+# Side of the cells of the shelters grid index, 0.1 degree is about 11 Km
+GRID_CELL_DEGREES = 0.1
+GRID_LON_CELLS = math.ceil(360 / GRID_CELL_DEGREES) + 1
+# Map shelters are clustered up to this zoom level, in CLUSTER_CELLS_PER_TILE x CLUSTER_CELLS_PER_TILE
+# cells per web map tile (a tile is 256 px, so about 64 px per cell)
+CLUSTER_MAX_ZOOM = int(os.getenv('MAP_CLUSTER_MAX_ZOOM', 11))
+CLUSTER_CELLS_PER_TILE = 4
+
+def haversine_km(latitudes, longitudes, lat, lon):
+    lat1 = np.radians(np.asarray(latitudes, dtype='float64'))
+    lon1 = np.radians(np.asarray(longitudes, dtype='float64'))
+    lat2 = np.radians(lat)
+    lon2 = np.radians(lon)
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def distance_haversine(latitudes, longitudes, lat, lon):
+    # Distances in Km from every (latitude, longitude) pair to the point (lat, lon), plus their "x.y Km" labels.
+    # Unknown coordinates, on either side, give a NaN distance and an empty label.
+    lat = np.nan if lat is None else lat
+    lon = np.nan if lon is None else lon
+    distances = haversine_km(latitudes, longitudes, lat, lon)
+
+    labels = np.char.mod('%.1f Km', distances).astype(object)
+    labels[np.isnan(distances)] = ''
+    return distances, labels
+
+def grid_cells(latitudes, longitudes):
+    lat_cells = np.floor((np.asarray(latitudes) + 90) / GRID_CELL_DEGREES).astype('int64')
+    lon_cells = np.floor((np.asarray(longitudes) + 180) / GRID_CELL_DEGREES).astype('int64')
+    return lat_cells, lon_cells
+
+def build_grid_index(latitudes, longitudes):
+    # Rows with known coordinates sorted by grid cell, so the shelters of a cell are one slice of `rows`
+    latitudes = np.asarray(latitudes, dtype='float64')
+    longitudes = np.asarray(longitudes, dtype='float64')
+    rows = np.flatnonzero(~np.isnan(latitudes) & ~np.isnan(longitudes))
+    lat_cells, lon_cells = grid_cells(latitudes[rows], longitudes[rows])
+    keys = lat_cells * GRID_LON_CELLS + lon_cells
+    order = np.argsort(keys, kind='stable')
+    return {'keys': keys[order], 'rows': rows[order], 'latitudes': latitudes, 'longitudes': longitudes}
+
+def within_radius(index, lat, lon, radius_km):
+    # Rows within radius_km of (lat, lon) and their distances, nearest first; only the cells of the
+    # bounding box of the circle are looked at (it does not wrap around the antimeridian, no shelter is near it)
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    if angle >= math.pi or abs(lat) + dlat >= 90 or math.sin(angle) >= math.cos(math.radians(lat)):
+        candidates = index['rows']
+    else:
+        dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+        (lat_low, lat_high), (lon_low, lon_high) = grid_cells([lat - dlat, lat + dlat], [max(lon - dlon, -180), min(lon + dlon, 180)])
+        bands = np.arange(lat_low, lat_high + 1) * GRID_LON_CELLS
+        starts = np.searchsorted(index['keys'], bands + lon_low, side='left')
+        ends = np.searchsorted(index['keys'], bands + lon_high, side='right')
+        candidates = np.concatenate([index['rows'][start:end] for start, end in zip(starts, ends)])
+
+    distances = haversine_km(index['latitudes'][candidates], index['longitudes'][candidates], lat, lon)
+    inside = distances <= radius_km
+    order = np.argsort(distances[inside], kind='stable')
+    return candidates[inside][order], distances[inside][order]
+
+def nearest(index, lat, lon, k, allowed=None):
+    # The k rows nearest to (lat, lon) among the `allowed` ones (a boolean mask, all rows when None) and their
+    # distances: radius searches growing until k rows are found
+    radius_km = GRID_CELL_DEGREES * math.pi * EARTH_RADIUS_KM / 180
+    while True:
+        rows, distances = within_radius(index, lat, lon, radius_km)
+        if allowed is not None:
+            rows, distances = rows[allowed[rows]], distances[allowed[rows]]
+        if len(rows) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+            return rows[:k], distances[:k]
+        radius_km *= 2
+
+def cluster_cells(latitudes, longitudes, zoom):
+    # Web mercator cell of every point at a zoom level, -1 for unknown coordinates
+    latitudes = np.clip(np.asarray(latitudes, dtype='float64'), -85.05, 85.05)
+    longitudes = np.asarray(longitudes, dtype='float64')
+    cells = 2 ** zoom * CLUSTER_CELLS_PER_TILE
+    x = (longitudes + 180) / 360
+    y = (1 - np.log(np.tan(np.pi / 4 + np.radians(latitudes) / 2)) / np.pi) / 2
+    known = ~np.isnan(x) & ~np.isnan(y)
+    # cells * cells keys no longer fit an int32 past zoom 13
+    keys = np.full(len(x), -1, dtype='int32' if cells * cells <= np.iinfo('int32').max else 'int64')
+    keys[known] = np.clip(np.floor(y[known] * cells), 0, cells - 1) * cells + np.clip(np.floor(x[known] * cells), 0, cells - 1)
+    return keys
+
+def build_cluster_index(latitudes, longitudes):
+    return {zoom: cluster_cells(latitudes, longitudes, zoom) for zoom in range(CLUSTER_MAX_ZOOM + 1)}
+
+def cluster_points(keys, latitudes, longitudes, values):
+    # Points sharing a cell merged into one: mean position, number of points and most frequent of `values`
+    # (small non negative ints) per cell
+    known = keys >= 0
+    cells, inverse, counts = np.unique(keys[known], return_inverse=True, return_counts=True)
+    latitudes = np.bincount(inverse, weights=np.asarray(latitudes, dtype='float64')[known], minlength=len(cells)) / np.maximum(counts, 1)
+    longitudes = np.bincount(inverse, weights=np.asarray(longitudes, dtype='float64')[known], minlength=len(cells)) / np.maximum(counts, 1)
+    values = np.asarray(values, dtype='int64')[known]
+    width = int(values.max()) + 1 if len(values) else 1
+    tally = np.bincount(inverse * width + values, minlength=len(cells) * width).reshape(len(cells), width)
+    return latitudes, longitudes, counts, tally.argmax(axis=1)
@@ -0,0 +1,121 @@
+import os
+import csv
+import json
+import bisect
+import logging
+import ipaddress
+import threading
+import redis
+from concurrent.futures import ThreadPoolExecutor
+from metrics import instrument_redis
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+client = instrument_redis(redis.Redis.from_url(redis_url), 'geolocation')
+
+# {ip} is replaced by the address looked up; point it at a local stub service to test without ipinfo.io
+GEOLOCATION_URL = os.getenv('GEOLOCATION_URL', 'https://ipinfo.io/{ip}/json')
+GEOLOCATION_TIMEOUT_SECONDS = float(os.getenv('GEOLOCATION_TIMEOUT_SECONDS', 3))
+GEOLOCATION_WORKERS = int(os.getenv('GEOLOCATION_WORKERS', 4))
+GEOLOCATION_TTL_SECONDS = int(os.getenv('GEOLOCATION_TTL_SECONDS', 24 * 3600))
+# Failed lookups are cached too, for less time, so a failing address is not looked up on every request
+GEOLOCATION_FAILURE_TTL_SECONDS = int(os.getenv('GEOLOCATION_FAILURE_TTL_SECONDS', 600))
+# CSV of IPv4 ranges (start,end,country,city,latitude,longitude,timezone) resolved locally, without any request
+GEOIP_RANGES_FILE = os.getenv('GEOIP_RANGES_FILE')
+# Requests that never need the user location
+SKIP_LOCATION_PATHS = ('/assets/', '/_dash-component-suites/', '/_favicon.ico', '/favicon.ico')
+
+location_stats = {'cached': 0, 'offline': 0, 'lookups': 0, 'failures': 0, 'coalesced': 0}
+_stats_lock = threading.Lock()
+_lookup_pool = None
+# Addresses being looked up in this worker, so sessions arriving from the same address share one lookup
+_pending = set()
+_pending_lock = threading.Lock()
+_offline = {'ranges': None}
+
+def count(stat):
+    with _stats_lock:
+        location_stats[stat] += 1
+
+def get_location_stats():
+    with _stats_lock:
+        return dict(location_stats)
+
+def load_ip_ranges(path):
+    # Sorted (starts, ranges) of the range file, for a bisect per address
+    ranges = []
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            ranges.append((
+                int(ipaddress.IPv4Address(row['start'])),
+                int(ipaddress.IPv4Address(row['end'])),
+                {
+                    'country': row['country'],
+                    'city': row['city'],
+                    'loc': f"{row['latitude']},{row['longitude']}" if row['latitude'] and row['longitude'] else None,
+                    'timezone': row['timezone'] or None,
+                },
+            ))
+    ranges.sort(key=lambda item: item[0])
+    return [start for start, _, _ in ranges], ranges
+
+def resolve_offline(ip):
+    # ipinfo-shaped response from GEOIP_RANGES_FILE, None when there is no file or no range holds the address
+    if not GEOIP_RANGES_FILE:
+        return None
+    if _offline['ranges'] is None:
+        _offline['ranges'] = load_ip_ranges(GEOIP_RANGES_FILE)
+        logging.info(f"Loaded {len(_offline['ranges'][1])} IP ranges from {GEOIP_RANGES_FILE}")
+    starts, ranges = _offline['ranges']
+    try:
+        address = int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+    position = bisect.bisect_right(starts, address) - 1
+    if position < 0 or address > ranges[position][1]:
+        return None
+    return {'ip': ip, **ranges[position][2]}
+
+def fetch_location(ip):
+    # Imported here, requests is only needed once a lookup runs and is slow to import
+    import requests
+    response = requests.get(GEOLOCATION_URL.format(ip=ip), timeout=GEOLOCATION_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.json()
+
+def lookup_location(ip, fetch):
+    try:
+        count('lookups')
+        response = fetch(ip)
+        client.setex(f"user_location:{ip}", GEOLOCATION_TTL_SECONDS, json.dumps(response))
+        logging.info(f"Location of {ip} added to Redis")
+    except Exception as e:
+        count('failures')
+        client.setex(f"user_location:{ip}", GEOLOCATION_FAILURE_TTL_SECONDS, json.dumps({'error': str(e)}))
+        logging.error(f"Error looking up the location of {ip}: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard(ip)
+
+def get_location(ip, fetch=fetch_location):
+    # Cached or offline response for ip, {'error': ...} for a cached failure. Otherwise None: the lookup is
+    # started in the background and a later request of the session picks its result up from Redis
+    cached_response = client.get(f"user_location:{ip}")
+    if cached_response:
+        count('cached')
+        return json.loads(cached_response)
+
+    response = resolve_offline(ip)
+    if response is not None:
+        count('offline')
+        return response
+
+    global _lookup_pool
+    with _pending_lock:
+        if ip in _pending:
+            count('coalesced')
+            return None
+        _pending.add(ip)
+        if _lookup_pool is None:
+            _lookup_pool = ThreadPoolExecutor(max_workers=GEOLOCATION_WORKERS, thread_name_prefix='geolocation')
+    _lookup_pool.submit(lookup_location, ip, fetch)
+    return None
@@ -2,60 +2,308 @@ import requests
 import redis
 import os
 import json
+import math
+import time
+import msgspec
 import pandas as pd
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from metrics import instrument_redis
+from snapshot_format import encode_frame
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-client = redis.Redis.from_url(redis_url)
+client = instrument_redis(redis.Redis.from_url(redis_url), 'refresh')
 API_URL = os.getenv('API_URL')
 FLASK_ENV = os.getenv('FLASK_ENV')
+PER_PAGE = 100
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 8))
+FETCH_RETRIES = int(os.getenv('FETCH_RETRIES', 4))
+FETCH_TIMEOUT_SECONDS = float(os.getenv('FETCH_TIMEOUT_SECONDS', 10))
+# Incremental refreshes only fetch shelters updated since the last one, with a full refresh every REFRESH_FULL_MINUTES
+REFRESH_INCREMENTAL = os.getenv('REFRESH_INCREMENTAL') == 'true'
+REFRESH_FULL_MINUTES = int(os.getenv('REFRESH_FULL_MINUTES', 180))
+CHANGES_TTL_SECONDS = 24 * 60 * 60
 
-def fetch_shelter_data():
-    endpoint = f"{API_URL}/shelters?perPage=100"
+SNAPSHOT_KEY = 'shelters_snapshot'
+SHELTERS_HASH_KEY = 'shelters_by_id'
+VERSION_KEY = 'shelters_version'
+CHANGES_KEY = 'shelters_changes'
+UPDATED_AT_KEY = 'shelters_updated_at'
+FULL_REFRESH_KEY = 'shelters_full_refresh'
+UPDATES_CHANNEL = 'shelters_updates'
+
+# Shelter fields the dashboard keeps; everything else the API sends (shelterSupplies, pix, street, zipCode...)
+# is skipped by the decoder without being materialized
+class Shelter(msgspec.Struct):
+    id: str
+    updatedAt: str
+    name: Optional[str] = None
+    address: Optional[str] = None
+    city: Optional[str] = None
+    petFriendly: Optional[bool] = None
+    shelteredPeople: Optional[int] = None
+    capacity: Optional[int] = None
+    contact: Optional[str] = None
+    verified: bool = False
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    actived: bool = False
+
+class ShelterPage(msgspec.Struct):
+    results: list[msgspec.Raw]
+    count: int
+
+class ShelterResponse(msgspec.Struct):
+    data: ShelterPage
+
+SHELTER_COLUMNS = [field for field in Shelter.__struct_fields__ if field != 'actived']
+# Fields the API is known to send and the dashboard drops on purpose
+DROPPED_FIELDS = {'shelterSupplies', 'pix', 'street', 'neighbourhood', 'streetNumber', 'prioritySum', 'zipCode', 'createdAt', 'category'}
+
+response_decoder = msgspec.json.Decoder(ShelterResponse)
+# strict=False accepts numbers sent as strings, the API is not consistent about it
+shelter_decoder = msgspec.json.Decoder(Shelter, strict=False)
+
+def decode_page(content):
+    # Shelters of a page and the schema drift seen in it, merged by the caller so concurrent pages share nothing
+    page = response_decoder.decode(content).data
+    schema_drift = new_schema_drift()
     shelters = []
-    total = 5000
-    page = 1
+    for raw in page.results:
+        try:
+            shelters.append(shelter_decoder.decode(raw))
+        except msgspec.ValidationError as err:
+            # One malformed shelter is counted and skipped instead of failing the whole refresh
+            schema_drift['invalid_records'] += 1
+            schema_drift['errors'].add(str(err))
+    return shelters, page.count, page.results, schema_drift
+
+def inspect_schema(raw_results, schema_drift):
+    # Compares the fields of a sample of shelters with the ones we expect
+    if not raw_results:
+        return
+    fields = set().union(*(msgspec.json.decode(raw) for raw in raw_results))
+    schema_drift['unknown_fields'] |= fields - set(Shelter.__struct_fields__) - DROPPED_FIELDS
+    schema_drift['missing_fields'] |= set(Shelter.__struct_fields__) - fields
 
-    while len(shelters) != total:
-        uri = f"{endpoint}&page={page}"
-        response = requests.get(uri)
-        data = response.json()
-        results = data['data']['results']
-        count = data['data']['count']
+def new_schema_drift():
+    return {'invalid_records': 0, 'errors': set(), 'unknown_fields': set(), 'missing_fields': set()}
 
-        shelters.extend(results)
-        total = count
-        page += 1
+def merge_schema_drift(schema_drift, page_drift):
+    schema_drift['invalid_records'] += page_drift['invalid_records']
+    for key in ['errors', 'unknown_fields', 'missing_fields']:
+        schema_drift[key] |= page_drift[key]
 
-    return shelters
+def report_schema_drift(schema_drift):
+    report = {key: sorted(value) if isinstance(value, set) else value for key, value in schema_drift.items()}
+    if schema_drift['invalid_records'] or schema_drift['unknown_fields'] or schema_drift['missing_fields']:
+        print(f"Shelters API schema drift: {report}")
+    return report
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+@retry(
+    stop=stop_after_attempt(FETCH_RETRIES),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception_type(requests.RequestException),
+    reraise=True,
+)
+def fetch_page(session, page, **params):
+    response = session.get(f"{API_URL}/shelters", params={'perPage': PER_PAGE, 'page': page, **params}, timeout=FETCH_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return decode_page(response.content)
+
+def fetch_shelter_data(schema_drift):
+    with create_session() as session:
+        # The first page tells how many pages there are, the rest are fetched concurrently
+        shelters, count, raw_results, page_drift = fetch_page(session, 1)
+        merge_schema_drift(schema_drift, page_drift)
+        inspect_schema(raw_results, schema_drift)
+        pages = math.ceil(count / PER_PAGE)
+
+        last_count = count
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for results, last_count, _, page_drift in executor.map(lambda page: fetch_page(session, page), range(2, pages + 1)):
+                shelters.extend(results)
+                merge_schema_drift(schema_drift, page_drift)
+
+    if last_count != count:
+        print(f"Shelter count changed while paging: {count} -> {last_count}")
+
+    # Shelters shift between pages when the count changes during paging, keep the last copy of each
+    return list({shelter.id: shelter for shelter in shelters}.values()), pages
+
+def fetch_changed_shelters(since, schema_drift):
+    # Pages sorted by most recently updated, until reaching shelters updated before `since`. Those updated at
+    # `since` itself are fetched again: one committed after the previous refresh may share its timestamp
+    changed = []
+    page = 1
+    with create_session() as session:
+        while True:
+            results, count, raw_results, page_drift = fetch_page(session, page, orderBy='updatedAt', order='desc')
+            merge_schema_drift(schema_drift, page_drift)
+            if page == 1:
+                inspect_schema(raw_results, schema_drift)
+            updated_at = [shelter.updatedAt for shelter in results]
+            if updated_at != sorted(updated_at, reverse=True):
+                raise ValueError('Shelters API did not sort by updatedAt, cannot refresh incrementally')
 
-def clean_data(data):
-    cleaned_data = [{k: v for k, v in item.items() if v is not None} for item in data]
-    df = pd.json_normalize(cleaned_data)
-    df = df[df['actived'] == True]
-    df.drop(['actived', 'shelterSupplies', 'pix', 'street', 'neighbourhood', 'streetNumber', 'prioritySum', 'zipCode', 'createdAt'], axis=1, inplace=True)
+            changed.extend(shelter for shelter in results if shelter.updatedAt >= since)
+            if not results or updated_at[-1] < since or page * PER_PAGE >= count:
+                return changed, page
+            page += 1
+
+def drop_stored_shelters(changed, since):
+    # The shelters updated at `since` that are stored as they are, so a refresh finding nothing else publishes nothing
+    fetched_again = [shelter for shelter in changed if shelter.updatedAt == since]
+    if not fetched_again:
+        return changed
+    # Compared as records, a column may be float in one frame and int in the other
+    records = {record['id']: record for record in json.loads(clean_data(fetched_again).to_json(orient='records'))}
+    stored = client.hmget(SHELTERS_HASH_KEY, [shelter.id for shelter in fetched_again])
+    unchanged = {shelter.id for shelter, value in zip(fetched_again, stored) if records.get(shelter.id) == (json.loads(value) if value is not None else None)}
+    return [shelter for shelter in changed if shelter.id not in unchanged]
+
+def clean_data(shelters):
+    # Columns are built straight from the decoded shelters, only the active ones are kept
+    active = [shelter for shelter in shelters if shelter.actived]
+    df = pd.DataFrame({column: [getattr(shelter, column) for shelter in active] for column in SHELTER_COLUMNS})
     df.drop_duplicates(inplace=True)
     return df
 
+def publish(write):
+    # Runs write(pipe, version) and bumps the data version in one transaction, so the app workers
+    # see the new version only together with its data; returns the new version
+    def transaction(pipe):
+        version = int(pipe.get(VERSION_KEY) or 0) + 1
+        pipe.multi()
+        write(pipe, version)
+        pipe.set(VERSION_KEY, version)
+        return version
+    version = client.transaction(transaction, VERSION_KEY, value_from_callable=True)
+    # Tells the app workers to swap in the new snapshot, they no longer check the version on every callback
+    client.publish(UPDATES_CHANNEL, version)
+    return version
+
+def refresh():
+    # Fetch, clean and store the shelters; returns what the refresh did, raises on failure
+    start = time.perf_counter()
+    schema_drift = new_schema_drift()
+    shelters, pages = fetch_shelter_data(schema_drift)
+    print(f"Shelters: {len(shelters)}")
+    fetched = time.perf_counter()
+
+    cleaned_shelters_df = clean_data(shelters)
+    # Convert the DataFrame to a JSON string
+    cleaned_shelters_json = cleaned_shelters_df.to_json(orient='records')
+    records = json.loads(cleaned_shelters_json)
+
+    # The snapshot embeds its version: encoded here for the version publish() should give, so the transaction
+    # only sends it, and encoded again there if another refresh published in between
+    encoded = {}
+    def encode(version):
+        if encoded.get('version') != version:
+            encoded.update(version=version, payload=encode_frame(cleaned_shelters_df, version))
+        return encoded['payload']
+    encode(int(client.get(VERSION_KEY) or 0) + 1)
+    cleaned = time.perf_counter()
+
+    # Store the cleaned shelter data in Redis, both as one binary snapshot and per shelter for the incremental refreshes
+    def write(pipe, version):
+        pipe.set(SNAPSHOT_KEY, encode(version))
+        pipe.delete(SHELTERS_HASH_KEY)
+        if records:
+            pipe.hset(SHELTERS_HASH_KEY, mapping={record['id']: json.dumps(record) for record in records})
+        if shelters:
+            pipe.set(UPDATED_AT_KEY, max(shelter.updatedAt for shelter in shelters))
+        pipe.set(FULL_REFRESH_KEY, version, ex=REFRESH_FULL_MINUTES * 60)
+    version = publish(write)
+    print(f'Shelter data has been updated in Redis (version {version})')
+    written = time.perf_counter()
+
+    if FLASK_ENV != 'production':
+        # Save the cleaned shelter data to a JSON file
+        with open('local.json', 'w') as f:
+            json.dump(records, f, indent=4)
+        print('Shelter data has been saved to local.json')
+
+    return {
+        'mode': 'full',
+        'schema_drift': report_schema_drift(schema_drift),
+        'version': version,
+        'pages_fetched': pages,
+        'rows_fetched': len(shelters),
+        'rows_kept': len(cleaned_shelters_df),
+        'bytes_written': len(encoded['payload']),
+        'phase_seconds': {'fetch': round(fetched - start, 3), 'clean': round(cleaned - fetched, 3), 'write': round(written - cleaned, 3)},
+        'duration_seconds': round(time.perf_counter() - start, 3),
+    }
+
+def refresh_incremental(changed=None):
+    # Merges the shelters updated since the last refresh into the stored ones, by id.
+    # `changed` skips the fetch, for callers that already have the changed shelters (as Shelter structs).
+    start = time.perf_counter()
+    since = client.get(UPDATED_AT_KEY)
+    if since is None or not client.exists(SHELTERS_HASH_KEY):
+        return refresh()
+
+    pages = 0
+    schema_drift = new_schema_drift()
+    if changed is None:
+        changed, pages = fetch_changed_shelters(since.decode('utf-8'), schema_drift)
+    changed = drop_stored_shelters(changed, since.decode('utf-8'))
+    fetched = time.perf_counter()
+
+    removed_ids = [shelter.id for shelter in changed if not shelter.actived]
+    records = json.loads(clean_data(changed).to_json(orient='records'))
+    values = {record['id']: json.dumps(record) for record in records}
+    cleaned = time.perf_counter()
+
+    version = None
+    if changed:
+        def write(pipe, version):
+            if values:
+                pipe.hset(SHELTERS_HASH_KEY, mapping=values)
+            if removed_ids:
+                pipe.hdel(SHELTERS_HASH_KEY, *removed_ids)
+            pipe.set(UPDATED_AT_KEY, max(shelter.updatedAt for shelter in changed))
+            # The app workers patch their snapshot with these ids instead of reloading every shelter
+            pipe.set(f'{CHANGES_KEY}:{version}', json.dumps(list(values) + removed_ids), ex=CHANGES_TTL_SECONDS)
+        version = publish(write)
+        print(f'{len(changed)} changed shelters have been merged in Redis (version {version})')
+
+    return {
+        'mode': 'incremental',
+        'schema_drift': report_schema_drift(schema_drift),
+        'version': version,
+        'pages_fetched': pages,
+        'rows_fetched': len(changed),
+        'rows_kept': len(records),
+        'rows_removed': len(removed_ids),
+        'bytes_written': sum(len(value.encode('utf-8')) for value in values.values()),
+        'phase_seconds': {'fetch': round(fetched - start, 3), 'clean': round(cleaned - fetched, 3), 'write': round(time.perf_counter() - cleaned, 3)},
+        'duration_seconds': round(time.perf_counter() - start, 3),
+    }
+
+def refresh_shelters():
+    if REFRESH_INCREMENTAL and client.exists(FULL_REFRESH_KEY):
+        try:
+            return refresh_incremental()
+        except ValueError as err:
+            print(f'Incremental refresh failed, running a full one: {err}')
+    return refresh()
+
 def main():
     try:
-        shelters = fetch_shelter_data()
-        id_count = sum(1 for item in shelters if "id" in item)
-        print(f"Shelters: {id_count}")
-
-        cleaned_shelters_df = clean_data(shelters)
-        # Convert the DataFrame to a JSON string
-        cleaned_shelters_json = cleaned_shelters_df.to_json(orient='records')
-
-        # Store the cleaned shelter data in Redis
-        client.set('shelters', cleaned_shelters_json)
-        print('Shelter data has been updated in Redis')
-
-        if FLASK_ENV != 'production':
-            # Save the cleaned shelter data to a JSON file
-            with open('local.json', 'w') as f:
-                json.dump(json.loads(cleaned_shelters_json), f, indent=4)
-            print('Shelter data has been saved to test.json')
+        print(refresh_shelters())
     except Exception as err:
         print(f'Error fetching shelter data: {err}')
 
@@ -0,0 +1,12 @@
+# Loaded by gunicorn from the working directory (see Procfile)
+import os
+import secrets
+
+# Drawn once in the master and inherited by every worker, which share the snapshot file named after it
+os.environ['SNAPSHOT_RUN_ID'] = secrets.token_hex(8)
+
+def post_worker_init(worker):
+    # Starts this worker's snapshot subscriber and scheduler right after the fork, so the snapshot is
+    # built or mapped before the first request instead of during it (APP_STARTUP=lazy)
+    import app
+    app.start_worker()
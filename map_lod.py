@@ -0,0 +1,53 @@
+import numpy as np
+from geo import CLUSTER_MAX_ZOOM, cluster_points
+
+# Level of detail of the shelters map: up to CLUSTER_MAX_ZOOM the shelters are sent as one marker per map cell
+# with their count, coloured by the most frequent availability; above it, only the shelters in view
+MAP_ZOOM = 9
+
+def get_map_view(relayout_data):
+    # Zoom and visible (lon_min, lat_min, lon_max, lat_max) of the map from its relayoutData; the bounds are
+    # only known once the user moved the map
+    relayout_data = relayout_data or {}
+    zoom = relayout_data.get('mapbox.zoom', MAP_ZOOM)
+    coordinates = (relayout_data.get('mapbox._derived') or {}).get('coordinates')
+    bounds = None
+    if coordinates:
+        lons, lats = zip(*coordinates)
+        bounds = (min(lons), min(lats), max(lons), max(lats))
+    return zoom, bounds
+
+def get_map_level(zoom):
+    # Cluster zoom level for a map zoom, None when the map shows every shelter
+    return None if zoom > CLUSTER_MAX_ZOOM else max(0, int(zoom))
+
+def cluster_traces(keys, latitudes, longitudes, statuses, status_styles, hover_label):
+    # One trace per availability, so the legend matches the point traces. status_styles maps a statusId to
+    # its {'name', 'color'}
+    latitudes, longitudes, counts, dominant = cluster_points(keys, latitudes, longitudes, statuses)
+    traces = []
+    for status_id, style in status_styles.items():
+        selected = dominant == status_id
+        if not selected.any():
+            continue
+        count = counts[selected]
+        traces.append({
+            'type': 'scattermapbox',
+            'mode': 'markers+text',
+            'lat': latitudes[selected].round(5).tolist(),
+            'lon': longitudes[selected].round(5).tolist(),
+            'text': count.tolist(),
+            'textfont': {'color': 'black', 'size': 11},
+            'marker': {'color': style['color'], 'size': (12 + 4 * np.log2(count)).round(1).tolist()},
+            'name': style['name'],
+            'legendgroup': style['name'],
+            'hovertemplate': f"%{{text}} {hover_label}<extra>{style['name']}</extra>",
+        })
+    return traces
+
+def in_view(latitudes, longitudes, bounds):
+    # Shelters inside bounds; all of them while the bounds are unknown
+    if bounds is None:
+        return np.ones(len(latitudes), dtype=bool)
+    lon_min, lat_min, lon_max, lat_max = bounds
+    return (latitudes >= lat_min) & (latitudes <= lat_max) & (longitudes >= lon_min) & (longitudes <= lon_max)
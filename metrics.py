@@ -0,0 +1,154 @@
+import os
+import math
+import time
+import random
+import logging
+import cProfile
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the stage latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Fraction of the Dash callbacks profiled with cProfile, 0 turns profiling off; /profiling changes it at runtime
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'shelters-profiles'))
+# Profiles kept in PROFILE_DIR, the oldest are removed past it
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 200))
+
+# Metrics of this worker: name -> {labels tuple -> value}, histograms keep [bucket counts..., sum, count]
+_counters = {}
+_gauges = {}
+_histograms = {}
+_metrics_lock = threading.Lock()
+_profiling = {'sample_rate': PROFILE_SAMPLE_RATE}
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def increment(name, amount=1, **labels):
+    with _metrics_lock:
+        values = _counters.setdefault(name, {})
+        key = label_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    with _metrics_lock:
+        _gauges.setdefault(name, {})[label_key(labels)] = value
+
+def observe(name, seconds, **labels):
+    with _metrics_lock:
+        values = _histograms.setdefault(name, {})
+        histogram = values.setdefault(label_key(labels), [0] * (len(LATENCY_BUCKETS) + 2))
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[position] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('shelters_stage_seconds', time.perf_counter() - start, stage=stage)
+
+def instrument_redis(client, name):
+    # Counts the round trips of client: one per command, and one per executed pipeline or transaction
+    # (as PIPELINE, whatever it holds); pub/sub connections are not counted
+    def counted(send):
+        def send_counted(*args, **options):
+            increment('shelters_redis_commands_total', client=name, command=str(args[0]).split()[0].upper())
+            return send(*args, **options)
+        return send_counted
+
+    def counted_pipeline(create):
+        def create_counted(*args, **options):
+            pipe = create(*args, **options)
+            # WATCH, and the reads of a transaction before its MULTI, are sent right away
+            pipe.immediate_execute_command = counted(pipe.immediate_execute_command)
+            execute = pipe.execute
+            def execute_counted(*args, **options):
+                if len(pipe):
+                    increment('shelters_redis_commands_total', client=name, command='PIPELINE')
+                return execute(*args, **options)
+            pipe.execute = execute_counted
+            return pipe
+        return create_counted
+
+    client.execute_command = counted(client.execute_command)
+    client.pipeline = counted_pipeline(client.pipeline)
+    return client
+
+def format_labels(key, **extra):
+    labels = dict(key, **extra)
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in sorted(escaped.items())) + '}'
+
+def render_metrics():
+    # Prometheus text exposition of this worker's metrics
+    lines = []
+    with _metrics_lock:
+        for kind, metrics in [('counter', _counters), ('gauge', _gauges)]:
+            for name, values in sorted(metrics.items()):
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(f'{name}{format_labels(key)} {value}' for key, value in values.items())
+        for name, values in sorted(_histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in values.items():
+                for bound, bucket_count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f'{name}_bucket{format_labels(key, le=bound)} {bucket_count}')
+                lines.append(f'{name}_bucket{format_labels(key, le="+Inf")} {histogram[-1]}')
+                lines.append(f'{name}_sum{format_labels(key)} {histogram[-2]}')
+                lines.append(f'{name}_count{format_labels(key)} {histogram[-1]}')
+    return '\n'.join(lines) + '\n'
+
+def get_profile_sample_rate():
+    return _profiling['sample_rate']
+
+def set_profile_sample_rate(sample_rate):
+    sample_rate = float(sample_rate)
+    if not math.isfinite(sample_rate):
+        raise ValueError(f'Profile sample rate must be a finite number, got {sample_rate}')
+    _profiling['sample_rate'] = min(max(sample_rate, 0.0), 1.0)
+
+def start_profile():
+    # A running profiler for a sampled callback, None for the others
+    if _profiling['sample_rate'] <= 0 or random.random() >= _profiling['sample_rate']:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another callback of this worker is being profiled (Python 3.12+ allows one profiler at a time)
+        return None
+    return profiler
+
+def dump_profile(profiler, name):
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # Dash outputs like "..map.figure...map-level.data.." as a file name
+    name = ''.join(character if character.isalnum() else '_' for character in name).strip('_') or 'callback'
+    path = os.path.join(PROFILE_DIR, f"{name}-{os.getpid()}-{time.time_ns()}.prof")
+    profiler.dump_stats(path)
+    logging.info(f"Callback profile written to {path}")
+    remove_old_profiles()
+    return path
+
+def remove_old_profiles():
+    profiles = []
+    for entry in os.scandir(PROFILE_DIR):
+        try:
+            if entry.name.endswith('.prof'):
+                profiles.append((entry.stat().st_mtime_ns, entry.path))
+        except FileNotFoundError:
+            pass
+    for _, path in sorted(profiles)[:max(len(profiles) - PROFILE_MAX_FILES, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Every worker trims the same directory, another one got to it first
+            pass
@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+import secrets
+import threading
+import redis
+from concurrent.futures import Future
+from metrics import instrument_redis
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+client = instrument_redis(redis.Redis.from_url(redis_url), 'refresh_lock')
+
+REFRESH_LOCK_KEY = 'shelters_refresh_lock'
+REFRESH_SLOT_KEY = 'shelters_refresh_slot'
+# Upper bound of a refresh; the lease expires on its own if its worker dies mid-refresh
+REFRESH_LOCK_SECONDS = int(os.getenv('REFRESH_LOCK_SECONDS', 300))
+REFRESH_WAIT_POLL_SECONDS = 0.5
+
+refresh_stats = {'started': 0, 'skipped': 0, 'coalesced': 0}
+_stats_lock = threading.Lock()
+# Refresh currently running in this worker, so concurrent callers wait for it instead of starting another
+_in_flight = {'future': None}
+_in_flight_lock = threading.Lock()
+
+# Deletes the lease only if it is still the one we took, never a lease another worker took after ours expired
+_release_lease = client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+def count(stat):
+    with _stats_lock:
+        refresh_stats[stat] += 1
+
+def get_refresh_stats():
+    with _stats_lock:
+        return dict(refresh_stats)
+
+def claim_interval(interval_seconds):
+    # Every worker's scheduler fires once per interval, only the first one in each interval gets to refresh
+    slot = int(time.time() // interval_seconds)
+    return client.set(f'{REFRESH_SLOT_KEY}:{slot}', secrets.token_hex(8), nx=True, px=int(interval_seconds * 1000))
+
+def wait_for_lease():
+    deadline = time.monotonic() + REFRESH_LOCK_SECONDS
+    while client.exists(REFRESH_LOCK_KEY) and time.monotonic() < deadline:
+        time.sleep(REFRESH_WAIT_POLL_SECONDS)
+
+def run_with_lease(run, scheduled, interval_seconds):
+    if scheduled and not claim_interval(interval_seconds):
+        count('skipped')
+        logging.info("Refresh skipped, another worker already refreshed in this interval")
+        return None
+
+    token = secrets.token_hex(16)
+    if not client.set(REFRESH_LOCK_KEY, token, nx=True, px=REFRESH_LOCK_SECONDS * 1000):
+        if scheduled:
+            count('skipped')
+            logging.info("Refresh skipped, another worker is refreshing")
+            return None
+        # Joins the other worker's refresh: returns once its data is written
+        count('coalesced')
+        logging.info("Waiting for the refresh running in another worker")
+        wait_for_lease()
+        return None
+
+    count('started')
+    try:
+        return run()
+    finally:
+        _release_lease(keys=[REFRESH_LOCK_KEY], args=[token])
+
+def run_refresh(run, scheduled=False, interval_seconds=None):
+    with _in_flight_lock:
+        future = _in_flight['future']
+        joining = future is not None and not future.done()
+        if not joining:
+            future = Future()
+            _in_flight['future'] = future
+
+    if joining:
+        count('coalesced')
+        return future.result()
+
+    try:
+        result = run_with_lease(run, scheduled, interval_seconds)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    future.set_result(result)
+    return result
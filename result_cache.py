@@ -0,0 +1,56 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 256))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', 900))
+
+# LRU of callback results shared by every session of this worker: key -> (expires_at, result)
+_results = OrderedDict()
+_results_lock = threading.Lock()
+result_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_cached_result(key, build):
+    now = time.monotonic()
+    with _results_lock:
+        entry = _results.get(key)
+        if entry is not None and entry[0] > now:
+            _results.move_to_end(key)
+            result_cache_stats['hits'] += 1
+            return entry[1]
+        result_cache_stats['misses'] += 1
+
+    # Built outside the lock, two sessions missing the same key at once just build it twice
+    result = build()
+
+    with _results_lock:
+        _results[key] = (now + RESULT_CACHE_TTL_SECONDS, result)
+        _results.move_to_end(key)
+        while len(_results) > RESULT_CACHE_SIZE:
+            _results.popitem(last=False)
+            result_cache_stats['evictions'] += 1
+    return result
+
+def get_result_cache_stats():
+    with _results_lock:
+        return {**result_cache_stats, 'size': len(_results), 'max_size': RESULT_CACHE_SIZE, 'ttl_seconds': RESULT_CACHE_TTL_SECONDS}
+
+def result_bytes(result):
+    # Bytes held by a cached result: arrays and frames (strings included), also inside dicts and tuples
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(deep=True).sum())
+    if isinstance(result, dict):
+        return sum(result_bytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(result_bytes(value) for value in result)
+    return 0
+
+def get_result_cache_bytes():
+    with _results_lock:
+        results = [result for _, result in _results.values()]
+    return sum(result_bytes(result) for result in results)
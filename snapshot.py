@@ -0,0 +1,501 @@
+import os
+import json
+import fcntl
+import glob
+import logging
+import mmap
+import secrets
+import tempfile
+import threading
+import time
+import redis
+import numpy as np
+import pandas as pd
+from metrics import instrument_redis, timed
+from geo import build_cluster_index, build_grid_index, nearest, within_radius
+from snapshot_format import decode_frame, encode_shared_frame, read_shared_frame, read_shared_version, take_text, text_contains
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+client = instrument_redis(redis.Redis.from_url(redis_url), 'snapshot')
+
+SHELTERS_KEY = 'shelters'
+SNAPSHOT_KEY = 'shelters_snapshot'
+SHELTERS_HASH_KEY = 'shelters_by_id'
+VERSION_KEY = 'shelters_version'
+CHANGES_KEY = 'shelters_changes'
+# Beyond this many versions behind, reloading every shelter is simpler than replaying the changes
+MAX_PATCHED_VERSIONS = 50
+
+AVAILABILITY_STATUS_IDS = {'Available': 1, 'Check': 2, 'Crowded': 3, 'Full': 4}
+STATUS_IDS = np.array(sorted(AVAILABILITY_STATUS_IDS.values()))
+
+SEARCH_COLUMNS = ['name', 'address', 'city']
+
+# Explicit dtypes of the snapshot frame; updatedAt is parsed to datetime64 in apply_schema
+SHELTER_DTYPES = {
+    'city': 'category',
+    'capacity': 'Int32',
+    'shelteredPeople': 'Int32',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'petFriendly': 'boolean',
+    'verified': 'bool',
+}
+
+UPDATES_CHANNEL = 'shelters_updates'
+SUBSCRIBER_RETRY_SECONDS = 5
+# The subscriber pings Redis and checks the data version this often. A connection dropped without a reset
+# (idle timeout of a load balancer or NAT) delivers nothing and raises nothing, the missing pong gives it away
+SUBSCRIBER_CHECK_SECONDS = float(os.getenv('SUBSCRIBER_CHECK_SECONDS', 30))
+
+# The formatted snapshot is written once per host to this file and every worker maps it read-only.
+# It is named after SNAPSHOT_RUN_ID, a token gunicorn.conf.py draws once per server start and the workers
+# inherit, so a restarted server never maps a file left by the previous one, even for the same data version.
+# A process started without it gets a file of its own. The worker building a snapshot removes the files of
+# the other runs; workers still mapping one keep their mapping until they swap it.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'shelters'))
+SNAPSHOT_RUN_ID = os.getenv('SNAPSHOT_RUN_ID') or f'{os.getpid()}-{secrets.token_hex(8)}'
+SNAPSHOT_FILE = os.path.join(SNAPSHOT_DIR, f'shelters-{SNAPSHOT_RUN_ID}.snapshot')
+SNAPSHOT_LOCK_FILE = os.path.join(SNAPSHOT_DIR, 'shelters.lock')
+
+# Formatted shelters of this worker, swapped only when get_api_data publishes a new version.
+# 'df' holds the typed columns mapped from the snapshot file, 'texts' the text columns left in it.
+_snapshot = {'version': None, 'df': None, 'texts': None, 'masks': None, 'geo': None, 'clusters': None, 'cube': None}
+_snapshot_lock = threading.Lock()
+# checked_at is when the subscriber last heard from Redis, None while it is not subscribed
+_subscriber = {'thread': None, 'checked_at': None}
+
+def parse_records(values):
+    return json.loads(b'[' + b','.join(values) + b']')
+
+def get_data():
+    # The per-shelter hash is kept up to date by incremental refreshes, the blob only by full ones
+    shelter_values = client.hvals(SHELTERS_HASH_KEY)
+    if shelter_values:
+        return parse_records(shelter_values)
+    shelter_data = client.get(SHELTERS_KEY)
+    if shelter_data:
+        return json.loads(shelter_data)
+    else:
+        with open('shelters.json', 'r') as file:
+            return json.load(file)
+
+def get_data_version():
+    version = client.get(VERSION_KEY)
+    return version.decode('utf-8') if version else None
+
+def format_count(values):
+    # Same text as f"{int(value)}", with '-' for missing counts
+    return values.fillna(0).astype('int64').astype(str).where(values.notna(), '-')
+
+def apply_schema(df):
+    df['verified'] = df['verified'].fillna(False)
+    for column, dtype in SHELTER_DTYPES.items():
+        if column not in df:
+            df[column] = None
+        df[column] = df[column].astype(dtype)
+    # Naive UTC, so the column maps straight from the snapshot file
+    df['updatedAt'] = pd.to_datetime(df['updatedAt'], format='ISO8601', utc=True).dt.tz_localize(None)
+    return df
+
+def format_data(df):
+    # Only typed columns are kept per shelter, the display strings come from format_display
+    df = apply_schema(df)
+    capacity = df['capacity'].to_numpy(dtype='float64', na_value=np.nan)
+    sheltered = df['shelteredPeople'].to_numpy(dtype='float64', na_value=np.nan)
+
+    df['vacancies'] = (df['capacity'] - df['shelteredPeople']).where((capacity >= 0) & (sheltered >= 0))
+    df['availability'] = np.select(
+        [np.isnan(capacity) | np.isnan(sheltered), sheltered > capacity, sheltered == capacity],
+        [AVAILABILITY_STATUS_IDS['Check'], AVAILABILITY_STATUS_IDS['Full'], AVAILABILITY_STATUS_IDS['Crowded']],
+        default=AVAILABILITY_STATUS_IDS['Available']
+    ).astype('int8')
+    return df.sort_values(by='updatedAt', ascending=False)
+
+def format_display(df):
+    # Display strings of the table columns, built only for the rows about to be shown
+    pet_icon = pd.Series(np.where(df['petFriendly'].fillna(False), '🐾', ''), index=df.index, dtype=object)
+    return df.assign(
+        # Markdown column with the source API url
+        link=pet_icon + ' [' + df['name'].astype(str) + '](https://sos-rs.com/abrigo/' + df['id'].astype(str) + ')',
+        capacity_info=format_count(df['shelteredPeople']) + '/' + format_count(df['capacity']),
+        vacancies=df['vacancies'].astype(object).where(df['vacancies'].notna(), '-'),
+        updatedAt=df['updatedAt'].dt.strftime('%d/%m/%Y %H:%M:%S'),
+    )
+
+def get_memory_report(df):
+    # Bytes held by each column of a shelters frame, strings included
+    columns = df.memory_usage(deep=True, index=False)
+    return {
+        'rows': len(df),
+        'total_bytes': int(columns.sum()),
+        'columns': {column: {'dtype': str(df[column].dtype), 'bytes': int(size)} for column, size in columns.items()},
+    }
+
+def fold_text(values):
+    # Lowercase and strip accents, so "sao joao" finds "São João"
+    return values.str.normalize('NFKD').str.replace(r'[\u0300-\u036f]', '', regex=True).str.lower()
+
+def build_search_index(df):
+    # One folded text per shelter; fields are joined by a newline so a query never matches across two of them
+    columns = [df[column].astype(object).fillna('').astype(str) for column in SEARCH_COLUMNS if column in df]
+    return fold_text(pd.Series(['\n'.join(values) for values in zip(*columns)], index=df.index, dtype=object))
+
+def search_mask(snapshot, search):
+    with timed('search'):
+        query = fold_text(pd.Series([search])).iloc[0]
+        return text_contains(snapshot['texts']['search_text'], query)
+
+def build_filter_masks(df):
+    # One boolean mask per filter value, so a filter combination is a few ANDs/ORs over the snapshot
+    masks = {'city': {}, 'availability': {}, 'verified': {}, 'petFriendly': {}}
+    city_codes = df['city'].cat.codes.to_numpy()
+    for code, city in enumerate(df['city'].cat.categories):
+        masks['city'][city] = city_codes == code
+    availability = df['availability'].to_numpy()
+    for status_id in AVAILABILITY_STATUS_IDS.values():
+        masks['availability'][status_id] = availability == status_id
+    for column in ['verified', 'petFriendly']:
+        for value in [True, False]:
+            masks[column][value] = (df[column] == value).to_numpy(dtype=bool, na_value=False)
+    return masks
+
+def build_aggregate_cube(df):
+    # Shelters and sheltered people per (city, availability, verified, petFriendly) cell, so the totals of a
+    # filter combination without search or distance add up a few cells instead of scanning the shelters.
+    # Axes: city code + 1 (0 for no city), position in STATUS_IDS, verified, petFriendly (0, 1, 2 for unknown)
+    shape = (len(df['city'].cat.categories) + 1, len(STATUS_IDS), 2, 3)
+    cells = np.ravel_multi_index((
+        df['city'].cat.codes.to_numpy().astype(np.int64) + 1,
+        np.searchsorted(STATUS_IDS, df['availability'].to_numpy()),
+        df['verified'].to_numpy(dtype=np.int64),
+        df['petFriendly'].to_numpy(dtype='float64', na_value=2).astype(np.int64),
+    ), shape)
+    people = df['shelteredPeople'].to_numpy(dtype='float64', na_value=0)
+    return {
+        'cities': {city: code + 1 for code, city in enumerate(df['city'].cat.categories)},
+        'count': np.bincount(cells, minlength=np.prod(shape)).reshape(shape),
+        'people': np.bincount(cells, weights=people, minlength=np.prod(shape)).astype(np.int64).reshape(shape),
+    }
+
+def cube_axis(size, positions):
+    axis = np.zeros(size, dtype=bool)
+    axis[positions] = True
+    return axis
+
+def aggregate_shelters(snapshot, cities=None, availability=None, verified=None, pet_friendly=None):
+    # summarize_shelters of filter_shelters(...) with the same filters, read from the snapshot cube
+    cube = snapshot['cube']
+    count = cube['count']
+    axes = [np.ones(size, dtype=bool) for size in count.shape]
+    if cities is not None:
+        axes[0] = cube_axis(count.shape[0], [cube['cities'][city] for city in cities if city in cube['cities']])
+    if availability is not None:
+        axes[1] = np.isin(STATUS_IDS, availability)
+    if verified is not None:
+        axes[2] = cube_axis(2, [int(verified)])
+    if pet_friendly is not None:
+        axes[3] = cube_axis(3, [int(pet_friendly)])
+    selected = axes[0][:, None, None, None] & axes[1][None, :, None, None] & axes[2][None, None, :, None] & axes[3][None, None, None, :]
+    count = np.where(selected, count, 0)
+    return {
+        'shelters': int(count.sum()),
+        'people': int(cube['people'][selected].sum()),
+        'verified': int(count[:, :, 1].sum()),
+        'not_verified': int(count[:, :, 0].sum()),
+        'pet_friendly': int(count[:, :, :, 1].sum()),
+        'availability': dict(zip(STATUS_IDS.tolist(), count.sum(axis=(0, 2, 3)).tolist())),
+    }
+
+def summarize_shelters(df):
+    # Totals of a filtered frame, for the filters the cube cannot answer
+    availability = df['availability'].to_numpy()
+    return {
+        'shelters': len(df),
+        'people': int(df['shelteredPeople'].sum()),
+        'verified': int(df['verified'].sum()),
+        'not_verified': int((~df['verified']).sum()),
+        'pet_friendly': int(df['petFriendly'].sum()),
+        'availability': {status_id: int((availability == status_id).sum()) for status_id in STATUS_IDS.tolist()},
+    }
+
+def any_of(masks, values, size):
+    selected = [masks[value] for value in values if value in masks]
+    return np.logical_or.reduce(selected) if selected else np.zeros(size, dtype=bool)
+
+def get_changed_ids(from_version, to_version):
+    # Ids changed by the incremental refreshes between two versions, None if any of them was a full refresh
+    try:
+        versions = range(int(from_version) + 1, int(to_version) + 1)
+    except (TypeError, ValueError):
+        return None
+    if not 0 < len(versions) <= MAX_PATCHED_VERSIONS:
+        return None
+    changes = client.mget([f'{CHANGES_KEY}:{version}' for version in versions])
+    if any(change is None for change in changes):
+        return None
+    return {shelter_id for change in changes for shelter_id in json.loads(change)}
+
+def with_text(snapshot, df, text_columns=None):
+    # df, rows of the snapshot frame, with text columns decoded for its rows only: text_columns, or every
+    # text column but search_text when None
+    if text_columns is None:
+        text_columns = [name for name in snapshot['texts'] if name != 'search_text']
+    indices = df.index.to_numpy()
+    return df.assign(**{name: take_text(snapshot['texts'][name], indices) for name in text_columns})
+
+def get_frame(snapshot, indices=None, text_columns=None):
+    # Snapshot rows (all of them when indices is None) as a regular frame
+    df = snapshot['df'] if indices is None else snapshot['df'].take(indices)
+    return with_text(snapshot, df, text_columns)
+
+def read_snapshot(buffer):
+    with timed('snapshot_indexes'):
+        df, texts, version = read_shared_frame(buffer)
+        return {
+            'version': version,
+            'df': df,
+            'texts': texts,
+            'masks': build_filter_masks(df),
+            'cube': build_aggregate_cube(df),
+            'geo': build_grid_index(df['latitude'], df['longitude']),
+            # Map cell of every shelter per zoom level, so the map clusters a filtered set without recomputing them
+            'clusters': build_cluster_index(df['latitude'], df['longitude']),
+        }
+
+def open_snapshot(version):
+    # The snapshot file of this host when it holds `version`, None otherwise
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    # The header tells the version, the indexes are only built for the one asked for
+    try:
+        current = version is not None and read_shared_version(buffer) == version
+    except ValueError:
+        current = False
+    if not current:
+        buffer.close()
+        return None
+    return read_snapshot(buffer)
+
+def share_snapshot(version, df):
+    # Writes the formatted frame for the other workers of this host, the rename swaps it in at once
+    df['city'] = df['city'].astype('category')
+    with timed('encode_shared_snapshot'):
+        payload = encode_shared_frame(df, version)
+    temp_file = f'{SNAPSHOT_FILE}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(temp_file, 'wb') as file:
+            file.write(payload)
+        os.replace(temp_file, SNAPSHOT_FILE)
+    except OSError as e:
+        logging.error(f"Shelter snapshot file not written, keeping the snapshot in this worker: {e}")
+        # A partial file, when the disk filled up while writing it
+        remove_file(temp_file)
+    return open_snapshot(version) or read_snapshot(payload)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Could not remove {path}: {e}")
+
+def remove_stale_snapshots():
+    # Snapshot files of previous server starts and of processes started without a run id
+    for path in glob.glob(os.path.join(SNAPSHOT_DIR, 'shelters-*.snapshot')):
+        if path != SNAPSHOT_FILE:
+            remove_file(path)
+
+def load_data():
+    # Raw shelters frame and the version it was written for, None when read from the JSON formats
+    with timed('redis_get_snapshot'):
+        payload = client.get(SNAPSHOT_KEY)
+    if payload:
+        with timed('decode_snapshot'):
+            df, data_version = decode_frame(payload)
+        return df, str(data_version)
+    data = get_data()
+    with timed('json_normalize'):
+        return pd.json_normalize(data), None
+
+def build_frame(version):
+    df, data_version = load_data()
+    with timed('format_data'):
+        df = format_data(df)
+        df['search_text'] = build_search_index(df)
+    if data_version is None or data_version == version:
+        return df
+
+    # The binary snapshot is only written by full refreshes, replay the incremental ones made since
+    changed_ids = get_changed_ids(data_version, version)
+    if changed_ids is None:
+        df = format_data(pd.json_normalize(get_data()))
+        df['search_text'] = build_search_index(df)
+        return df
+    return patch_frame(df, changed_ids)
+
+def patch_frame(df, changed_ids):
+    # Reformats only the changed shelters; removed ones are simply missing from the hash
+    values = client.hmget(SHELTERS_HASH_KEY, list(changed_ids)) if changed_ids else []
+    records = parse_records([value for value in values if value is not None])
+    frames = [df[~df['id'].isin(changed_ids)].astype({'city': object})]
+    if records:
+        changed = format_data(pd.json_normalize(records))
+        changed['search_text'] = build_search_index(changed)
+        frames.append(changed)
+    return pd.concat(frames, ignore_index=True).sort_values(by='updatedAt', ascending=False)
+
+def update_snapshot(version):
+    global _snapshot
+    with _snapshot_lock:
+        # Another thread may have rebuilt it while we waited for the lock
+        if version is None or version != _snapshot['version'] or _snapshot['df'] is None:
+            # Another worker of this host may have written it already
+            snapshot = open_snapshot(version)
+            if snapshot is None:
+                os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+                with open(SNAPSHOT_LOCK_FILE, 'w') as lock:
+                    # Only one worker per host builds a version, the others wait and map its file
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    snapshot = open_snapshot(version) or build_snapshot(version)
+                    remove_stale_snapshots()
+            # Swap the whole snapshot at once, callbacks holding the previous one keep a consistent view
+            _snapshot = snapshot
+        return _snapshot
+
+def build_snapshot(version):
+    changed_ids = get_changed_ids(_snapshot['version'], version) if _snapshot['df'] is not None else None
+    if changed_ids is None:
+        snapshot = share_snapshot(version, build_frame(version))
+        logging.info(f"Shelter snapshot rebuilt (version {version}, {len(snapshot['df'])} rows)")
+    else:
+        snapshot = share_snapshot(version, patch_frame(get_frame(_snapshot, text_columns=list(_snapshot['texts'])), changed_ids))
+        logging.info(f"Shelter snapshot patched (version {version}, {len(changed_ids)} changed shelters)")
+    return snapshot
+
+def subscriber_is_live():
+    checked_at = _subscriber['checked_at']
+    return checked_at is not None and time.monotonic() - checked_at <= 2 * SUBSCRIBER_CHECK_SECONDS
+
+def get_snapshot_version():
+    # Version this worker serves, without checking Redis or building anything
+    return _snapshot['version']
+
+def get_snapshot():
+    snapshot = _snapshot
+    # While the subscriber is live it swaps in new versions and callbacks never ask Redis
+    if subscriber_is_live() and snapshot['df'] is not None:
+        return snapshot
+
+    version = get_data_version()
+    if version is not None and version == snapshot['version']:
+        return snapshot
+    return update_snapshot(version)
+
+def listen_for_updates():
+    while True:
+        pubsub = None
+        try:
+            pubsub = client.pubsub()
+            pubsub.subscribe(UPDATES_CHANNEL)
+            # Catch up with anything published while we were not listening
+            update_snapshot(get_data_version())
+            _subscriber['checked_at'] = answered_at = time.monotonic()
+            while True:
+                message = pubsub.get_message(timeout=SUBSCRIBER_CHECK_SECONDS)
+                now = time.monotonic()
+                if message is not None:
+                    answered_at = now
+                    if message['type'] == 'message':
+                        update_snapshot(message['data'].decode('utf-8'))
+                if now - _subscriber['checked_at'] >= SUBSCRIBER_CHECK_SECONDS:
+                    if now - answered_at > 2 * SUBSCRIBER_CHECK_SECONDS:
+                        raise ConnectionError(f'no answer from Redis in {now - answered_at:.0f} seconds')
+                    pubsub.ping()
+                    # Covers a message lost while the connection was failing
+                    update_snapshot(get_data_version())
+                    _subscriber['checked_at'] = now
+        except Exception as e:
+            logging.error(f"Shelter updates subscriber failed: {e}")
+        finally:
+            _subscriber['checked_at'] = None
+            if pubsub is not None:
+                pubsub.close()
+        time.sleep(SUBSCRIBER_RETRY_SECONDS)
+
+def start_snapshot_subscriber():
+    if _subscriber['thread'] is None or not _subscriber['thread'].is_alive():
+        # A forked process inherits when its parent's subscriber last heard from Redis, not the thread itself
+        _subscriber['checked_at'] = None
+        _subscriber['thread'] = threading.Thread(target=listen_for_updates, name='snapshot-subscriber', daemon=True)
+        _subscriber['thread'].start()
+
+def get_snapshot_memory():
+    snapshot = get_snapshot()
+    columns = get_memory_report(snapshot['df'])['columns']
+    for name, text in snapshot['texts'].items():
+        columns[name] = {'dtype': 'text', 'bytes': int(text['offsets'][-1]) + text['offsets'].nbytes + text['null'].nbytes}
+    return {
+        'version': snapshot['version'],
+        # Columns mapped from the snapshot file are one copy per host, whatever the number of workers
+        'mapped': any(isinstance(text['buffer'], mmap.mmap) for text in snapshot['texts'].values()),
+        'shared_bytes': sum(column['bytes'] for column in columns.values()),
+        'worker_bytes': sum(mask.nbytes for masks in snapshot['masks'].values() for mask in masks.values()),
+        'columns': columns,
+    }
+
+def get_formated_data():
+    return get_snapshot()['df']
+
+def near_mask(snapshot, selected, lat, lon, radius_km=None, k=None):
+    # Selected shelters within radius_km of (lat, lon), or the k nearest of them; none for an unknown location
+    if lat is None or lon is None:
+        return np.zeros(len(selected), dtype=bool)
+    if radius_km is not None:
+        rows, _ = within_radius(snapshot['geo'], lat, lon, radius_km)
+        rows = rows[selected[rows]]
+    else:
+        rows, _ = nearest(snapshot['geo'], lat, lon, k, allowed=selected)
+    mask = np.zeros(len(selected), dtype=bool)
+    mask[rows] = True
+    return mask
+
+def select_shelters(search=None, cities=None, availability=None, verified=None, pet_friendly=None, near=None, snapshot=None):
+    # Rows of the snapshot frame matching the filters, in snapshot order. None means "no filter";
+    # near is a near_mask (lat, lon, radius_km, k) tuple
+    snapshot = snapshot or get_snapshot()
+    masks = snapshot['masks']
+    size = len(snapshot['df'])
+
+    selected = [np.ones(size, dtype=bool)]
+    if search:
+        selected.append(search_mask(snapshot, search))
+    if cities is not None:
+        selected.append(any_of(masks['city'], cities, size))
+    if availability is not None:
+        selected.append(any_of(masks['availability'], availability, size))
+    if verified is not None:
+        selected.append(any_of(masks['verified'], [verified], size))
+    if pet_friendly is not None:
+        selected.append(any_of(masks['petFriendly'], [pet_friendly], size))
+
+    with timed('filter_masks'):
+        selected = np.logical_and.reduce(selected)
+    if near is not None:
+        with timed('near'):
+            selected = near_mask(snapshot, selected, *near)
+    rows = np.flatnonzero(selected)
+    rows.setflags(write=False)
+    return rows
+
+def filter_shelters(snapshot=None, text_columns=None, **filters):
+    # The shelters of select_shelters as a new frame, the snapshot itself is never handed out for editing
+    snapshot = snapshot or get_snapshot()
+    rows = select_shelters(snapshot=snapshot, **filters)
+    with timed('take_rows'):
+        return get_frame(snapshot, rows, text_columns)
@@ -0,0 +1,167 @@
+import os
+import msgspec
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Columnar binary snapshot of the cleaned shelters: numeric and boolean columns are raw little-endian
+# array bytes, every other column a msgpack list. The magic prefix tells how the payload is compressed.
+MAGIC_RAW = b'SNP1'
+MAGIC_ZSTD = b'SNZ1'
+SNAPSHOT_COMPRESSION = os.getenv('SNAPSHOT_COMPRESSION', 'zstd' if zstandard else 'none')
+
+def encode_frame(df, version):
+    columns = []
+    for name, values in df.items():
+        if values.dtype.kind in 'biuf':
+            data = values.to_numpy()
+            columns.append({'name': name, 'dtype': data.dtype.newbyteorder('<').str, 'data': data.astype(data.dtype.newbyteorder('<')).tobytes()})
+        else:
+            columns.append({'name': name, 'values': values.astype(object).where(values.notna(), None).tolist()})
+    payload = msgspec.msgpack.encode({'version': version, 'rows': len(df), 'columns': columns})
+
+    if SNAPSHOT_COMPRESSION == 'zstd' and zstandard is not None:
+        return MAGIC_ZSTD + zstandard.ZstdCompressor(level=3).compress(payload)
+    return MAGIC_RAW + payload
+
+def decode_frame(payload):
+    # Returns the frame and the data version it was written for
+    magic, payload = payload[:4], payload[4:]
+    if magic == MAGIC_ZSTD:
+        if zstandard is None:
+            raise ValueError('Shelters snapshot is zstd compressed but zstandard is not installed')
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif magic != MAGIC_RAW:
+        raise ValueError('Unknown shelters snapshot format')
+
+    snapshot = msgspec.msgpack.decode(payload)
+    columns = {}
+    for column in snapshot['columns']:
+        if 'data' in column:
+            columns[column['name']] = np.frombuffer(column['data'], dtype=column['dtype'])
+        else:
+            # Missing values come back as None, like the nulls of the JSON snapshot
+            values = np.empty(snapshot['rows'], dtype=object)
+            values[:] = column['values']
+            columns[column['name']] = values
+    return pd.DataFrame(columns, index=pd.RangeIndex(snapshot['rows'])), snapshot['version']
+
+# Snapshot file shared by the app workers of a host: a msgpack header, then every column as raw arrays
+# aligned to ALIGNMENT bytes, so workers map the file instead of copying it. Text columns are one UTF-8
+# buffer plus row offsets, decoded only for the rows a callback takes.
+MAGIC_SHARED = b'SHM1'
+ALIGNMENT = 64
+MASKED_DTYPES = {'Int8': 'int8', 'Int16': 'int16', 'Int32': 'int32', 'Int64': 'int64', 'Float32': 'float32', 'Float64': 'float64', 'boolean': 'bool'}
+
+def encode_shared_frame(df, version):
+    chunks = []
+    size = 0
+
+    def add(array):
+        nonlocal size
+        padding = -size % ALIGNMENT
+        data = np.ascontiguousarray(array).tobytes()
+        chunks.append(b'\0' * padding + data)
+        size += padding + len(data)
+        return [size - len(data), array.dtype.str, len(array)]
+
+    columns = []
+    for name, values in df.items():
+        dtype_name = str(values.dtype)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            columns.append({'name': name, 'kind': 'category', 'codes': add(values.cat.codes.to_numpy()), 'categories': values.cat.categories.tolist()})
+        elif dtype_name in MASKED_DTYPES:
+            data = values.to_numpy(dtype=MASKED_DTYPES[dtype_name], na_value=0)
+            columns.append({'name': name, 'kind': 'masked', 'dtype': dtype_name, 'data': add(data), 'mask': add(values.isna().to_numpy())})
+        elif values.dtype.kind in 'biufM':
+            columns.append({'name': name, 'kind': 'array', 'data': add(values.to_numpy())})
+        else:
+            null = values.isna().to_numpy()
+            encoded = [b'' if missing else str(value).encode('utf-8') for value, missing in zip(values.tolist(), null)]
+            offsets = np.zeros(len(encoded) + 1, dtype='int64')
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            columns.append({'name': name, 'kind': 'text', 'data': add(np.frombuffer(b''.join(encoded), dtype='uint8')), 'offsets': add(offsets), 'null': add(null)})
+
+    header = msgspec.msgpack.encode({'version': version, 'rows': len(df), 'columns': columns})
+    start = 12 + len(header)
+    return MAGIC_SHARED + len(header).to_bytes(8, 'little') + header + b'\0' * (-start % ALIGNMENT) + b''.join(chunks)
+
+def read_shared_header(buffer):
+    if bytes(buffer[:4]) != MAGIC_SHARED:
+        raise ValueError('Unknown shared shelters snapshot format')
+    header_size = int.from_bytes(buffer[4:12], 'little')
+    try:
+        return msgspec.msgpack.decode(buffer[12:12 + header_size]), header_size
+    except msgspec.DecodeError as e:
+        raise ValueError(f'Corrupt shared shelters snapshot header: {e}')
+
+def read_shared_version(buffer):
+    # Data version of a shared snapshot, without reading its columns
+    return read_shared_header(buffer)[0]['version']
+
+def read_shared_frame(buffer):
+    # `buffer` is a read-only mmap of the snapshot file or the encoded bytes; nothing is copied out of it.
+    # Returns the frame of the non-text columns, the text columns and the data version.
+    snapshot, header_size = read_shared_header(buffer)
+    base = 12 + header_size
+    base += -base % ALIGNMENT
+
+    def array(entry):
+        offset, dtype, count = entry
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=base + offset)
+
+    columns = {}
+    texts = {}
+    for column in snapshot['columns']:
+        name = column['name']
+        if column['kind'] == 'category':
+            columns[name] = pd.Categorical.from_codes(array(column['codes']), column['categories'], validate=False)
+        elif column['kind'] == 'masked':
+            data, mask = array(column['data']), array(column['mask'])
+            if column['dtype'] == 'boolean':
+                columns[name] = pd.arrays.BooleanArray(data, mask)
+            elif data.dtype.kind == 'f':
+                columns[name] = pd.arrays.FloatingArray(data, mask)
+            else:
+                columns[name] = pd.arrays.IntegerArray(data, mask)
+        elif column['kind'] == 'array':
+            columns[name] = array(column['data'])
+        else:
+            texts[name] = {'buffer': buffer, 'start': base + column['data'][0], 'offsets': array(column['offsets']), 'null': array(column['null'])}
+    df = pd.DataFrame(columns, index=pd.RangeIndex(snapshot['rows']), copy=False)
+    return df, texts, snapshot['version']
+
+def take_text(text, indices=None):
+    # Decodes the rows `indices` (all of them when None) of a text column into an object array
+    offsets, null = text['offsets'], text['null']
+    if indices is None:
+        starts, ends = offsets[:-1], offsets[1:]
+    else:
+        indices = np.asarray(indices, dtype='int64')
+        starts, ends, null = offsets[indices], offsets[indices + 1], null[indices]
+    view = memoryview(text['buffer'])[text['start']:]
+    values = np.empty(len(starts), dtype=object)
+    values[:] = [None if missing else str(view[start:end], 'utf-8') for start, end, missing in zip(starts.tolist(), ends.tolist(), null.tolist())]
+    return values
+
+def text_contains(text, query):
+    # Rows of a text column containing `query`, searched directly in the shared buffer: positions matching
+    # the first byte of the query are narrowed down byte by byte, then mapped back to their rows
+    offsets = text['offsets']
+    data = np.frombuffer(text['buffer'], dtype='uint8', count=int(offsets[-1]), offset=text['start'])
+    query = np.frombuffer(query.encode('utf-8'), dtype='uint8')
+    found = np.zeros(len(offsets) - 1, dtype=bool)
+    if len(query) > len(data):
+        return found
+
+    positions = np.flatnonzero(data[:len(data) - len(query) + 1] == query[0])
+    for shift in range(1, len(query)):
+        positions = positions[data[positions + shift] == query[shift]]
+    rows = np.searchsorted(offsets, positions, side='right') - 1
+    # A match running into the next row does not count
+    found[rows[positions + len(query) <= offsets[rows + 1]]] = True
+    return found
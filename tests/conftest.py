@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import pytest
+import snapshot
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        stub = self.server.stub
+        with stub['lock']:
+            stub['requests'].append((url.path, dict(parse_qsl(url.query))))
+        status, body, delay = stub['respond'](url.path, dict(parse_qsl(url.query)))
+        if delay:
+            time.sleep(delay)
+        payload = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting (a timeout test)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def http_stub():
+    # Local HTTP service: set stub['respond'] to a function (path, query) -> (status, json body, delay in seconds);
+    # every request is recorded in stub['requests']
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.stub = {
+        'url': f'http://127.0.0.1:{server.server_address[1]}',
+        'requests': [],
+        'lock': threading.Lock(),
+        'respond': lambda path, query: (404, {}, 0),
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.stub
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def shared_snapshot():
+    # 2000 synthetic shelters as the frame they were encoded from and the snapshot read back from the file format
+    from benchmarks.synthetic import make_shelters
+    from snapshot_format import encode_shared_frame
+    df = snapshot.format_data(snapshot.pd.json_normalize(make_shelters(2000)))
+    df['search_text'] = snapshot.build_search_index(df)
+    df['city'] = df['city'].astype('category')
+    return df.reset_index(drop=True), snapshot.read_snapshot(encode_shared_frame(df, '1'))
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    # Snapshot files of the test in a directory of its own, and no snapshot in this worker yet
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_DIR', str(tmp_path))
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_FILE', str(tmp_path / 'shelters-current.snapshot'))
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_LOCK_FILE', str(tmp_path / 'shelters.lock'))
+    monkeypatch.setattr(snapshot, '_snapshot', {**snapshot._snapshot, 'version': None, 'df': None})
+    return tmp_path
@@ -0,0 +1,131 @@
+import os
+import fakeredis
+import pytest
+import app
+import metrics
+import snapshot
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_gauges', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+
+def test_refresh_metrics_export_the_schema_drift(fresh_metrics):
+    app.record_refresh_metrics({
+        'mode': 'full',
+        'schema_drift': {'invalid_records': 3, 'errors': ['Expected `int`'], 'unknown_fields': ['rescueTeam'], 'missing_fields': ['contact', 'pix']},
+        'duration_seconds': 1.5,
+    })
+
+    exported = metrics.render_metrics()
+    assert 'shelters_schema_invalid_records{mode="full"} 3' in exported
+    assert 'shelters_schema_unknown_fields{mode="full"} 1' in exported
+    assert 'shelters_schema_missing_fields{mode="full"} 2' in exported
+
+def test_a_forked_worker_starts_its_own_scheduler(monkeypatch):
+    monkeypatch.setattr(app, 'start_snapshot_subscriber', lambda: None)
+    monkeypatch.setattr(app, 'scheduler', app.create_scheduler())
+    monkeypatch.setattr(app, '_worker', {'pid': None})
+    # What --preload with APP_STARTUP=eager used to do: the scheduler already runs in the master
+    app.start_worker()
+    try:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                inherited = app.scheduler
+                app.start_worker()
+                ok = app.scheduler is not inherited and app.scheduler.running and app.scheduler.get_job('update_job') is not None
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+    finally:
+        app.scheduler.shutdown(wait=False)
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app.server.session_interface, 'client', fakeredis.FakeRedis())
+    monkeypatch.setattr(app, 'start_worker', lambda: None)
+    monkeypatch.setattr(app, 'get_user_language_and_location', lambda: app.DEFAULT_LOCATION)
+    monkeypatch.setattr(metrics, '_profiling', {'sample_rate': 0.0})
+    return app.server.test_client()
+
+def test_profiling_rate_needs_the_token(client, monkeypatch):
+    monkeypatch.setattr(app, 'PROFILING_TOKEN', None)
+    assert client.post('/profiling', json={'sample_rate': 1}, headers={'X-Profiling-Token': ''}).status_code == 403
+
+    monkeypatch.setattr(app, 'PROFILING_TOKEN', 'letmein')
+    assert client.post('/profiling', json={'sample_rate': 1}).status_code == 403
+    assert client.post('/profiling', json={'sample_rate': 1}, headers={'X-Profiling-Token': 'guess'}).status_code == 403
+    assert metrics.get_profile_sample_rate() == 0
+
+    response = client.post('/profiling', json={'sample_rate': 0.25}, headers={'X-Profiling-Token': 'letmein'})
+    assert response.status_code == 200 and response.json == {'sample_rate': 0.25}
+    assert client.get('/profiling').json == {'sample_rate': 0.25}
+
+@pytest.mark.parametrize('sample_rate', ['nan', 'inf', '-inf', 'often', None, [1]])
+def test_profiling_rate_must_be_a_finite_number(client, monkeypatch, sample_rate):
+    monkeypatch.setattr(app, 'PROFILING_TOKEN', 'letmein')
+    response = client.post('/profiling', json={'sample_rate': sample_rate}, headers={'X-Profiling-Token': 'letmein'})
+    assert response.status_code == 400
+    assert metrics.get_profile_sample_rate() == 0
+
+def test_only_the_newest_profiles_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, 'PROFILE_MAX_FILES', 3)
+    (tmp_path / 'notes.txt').write_text('not a profile')
+    paths = []
+    for _ in range(5):
+        profiler = metrics.cProfile.Profile()
+        profiler.enable()
+        paths.append(metrics.dump_profile(profiler, '..table.data..'))
+
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(path) for path in paths[-3:]] + ['notes.txt'])
+
+def test_metrics_do_not_build_the_snapshot(client, fresh_metrics, monkeypatch):
+    def build():
+        raise AssertionError('/metrics built the snapshot')
+    monkeypatch.setattr(app, 'get_snapshot', build)
+    monkeypatch.setattr(snapshot, 'update_snapshot', build)
+    monkeypatch.setattr(snapshot, '_snapshot', {**snapshot._snapshot, 'version': 42})
+
+    assert 'shelters_snapshot_version 42' in client.get('/metrics').get_data(as_text=True)
+
+@pytest.mark.parametrize('distance', ['nearest:10', 'km:50'])
+def test_distance_filters_without_a_location_match_no_shelter(client, shared_snapshot, monkeypatch, distance):
+    _, shared = shared_snapshot
+    monkeypatch.setattr(app, 'get_snapshot', lambda: shared)
+    with app.server.test_request_context('/'):
+        app.session['language'], app.session['lat'], app.session['lon'] = 'pt-br', None, None
+        data = app.update_filter_result(None, None, 'Todos', 'Todos', ['Todos'], distance, None, None)
+        (_, rows), _ = app.get_stored_result(data)
+        totals, _ = app.get_stored_totals(data)
+        notice = app.update_distance_notice(data)
+
+    assert len(rows) == 0 and totals['shelters'] == 0
+    assert notice == app.dict_columns['NoLocation']['pt-br']
+
+def test_distance_filters_near_the_location(client, shared_snapshot, monkeypatch):
+    _, shared = shared_snapshot
+    monkeypatch.setattr(app, 'get_snapshot', lambda: shared)
+    with app.server.test_request_context('/'):
+        app.session['language'], app.session['lat'], app.session['lon'] = 'pt-br', -30.0331, -51.23
+        data = app.update_filter_result(None, None, 'Todos', 'Todos', ['Todos'], 'nearest:10', None, None)
+        (_, rows), _ = app.get_stored_result(data)
+        notice = app.update_distance_notice(data)
+
+    assert len(rows) == 10 and notice == ''
+
+def test_session_round_trips_are_counted(client, fresh_metrics, monkeypatch):
+    # The instrumented session client of the app, talking to fakeredis
+    session_client = app.server.config['SESSION_REDIS']
+    monkeypatch.setattr(session_client, 'connection_pool', fakeredis.FakeRedis().connection_pool)
+    monkeypatch.setattr(app.server.session_interface, 'client', session_client)
+
+    client.get('/location-stats')
+    client.get('/location-stats')
+
+    counts = {dict(key)['command']: count for key, count in metrics._counters['shelters_redis_commands_total'].items() if dict(key)['client'] == 'session'}
+    assert counts.get('GET', 0) >= 1 and counts.get('SET', 0) >= 1
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import warnings
+from geo import cluster_cells, cluster_points, distance_haversine
+
+PORTO_ALEGRE = (-30.0331, -51.23)
+CITIES = {
+    'Caxias do Sul': ((-29.1678, -51.1789), 96.3),
+    'Pelotas': ((-31.7654, -52.3376), 219.7),
+    'Santa Maria': ((-29.6842, -53.8069), 251.5),
+}
+
+@pytest.mark.parametrize('city', CITIES)
+def test_distance_between_cities(city):
+    (latitude, longitude), expected_km = CITIES[city]
+    distances, labels = distance_haversine([latitude], [longitude], *PORTO_ALEGRE)
+    assert distances[0] == pytest.approx(expected_km, abs=0.05)
+    assert labels[0] == f'{expected_km:.1f} Km'
+
+def test_latitudes_and_longitudes_are_not_swapped():
+    latitudes = [coordinates[0] for coordinates, _ in CITIES.values()]
+    longitudes = [coordinates[1] for coordinates, _ in CITIES.values()]
+    distances, _ = distance_haversine(latitudes, longitudes, *PORTO_ALEGRE)
+    assert distances == pytest.approx([km for _, km in CITIES.values()], abs=0.05)
+
+def test_nan_coordinates():
+    distances, labels = distance_haversine([np.nan, -29.1678], [-51.1789, np.nan], *PORTO_ALEGRE)
+    assert np.isnan(distances).all()
+    assert list(labels) == ['', '']
+
+def test_no_session_location():
+    distances, labels = distance_haversine([-29.1678, -31.7654], [-51.1789, -52.3376], None, None)
+    assert np.isnan(distances).all()
+    assert list(labels) == ['', '']
+
+@pytest.mark.parametrize('zoom', [0, 11, 13, 14, 18, 22])
+def test_cluster_cells_at_every_zoom(zoom):
+    latitudes = [coordinates[0] for coordinates, _ in CITIES.values()] + [np.nan]
+    longitudes = [coordinates[1] for coordinates, _ in CITIES.values()] + [np.nan]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        keys = cluster_cells(latitudes, longitudes, zoom)
+
+    assert (keys[:-1] >= 0).all() and keys[-1] == -1
+    _, _, counts, _ = cluster_points(keys, latitudes, longitudes, [1, 2, 3, 4])
+    # The cities are far enough apart to stay in cells of their own past zoom 5
+    assert counts.sum() == 3 and (zoom < 5 or len(counts) == 3)
@@ -0,0 +1,146 @@
+import threading
+import time
+import fakeredis
+import pytest
+import app
+import geolocation
+
+IP = '203.0.113.7'
+STUB_LOCATION = {'ip': IP, 'city': 'Pelotas', 'country': 'BR', 'loc': '-31.7654,-52.3376', 'timezone': 'America/Sao_Paulo'}
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(geolocation, 'client', client)
+    monkeypatch.setattr(app.server.session_interface, 'client', client)
+    monkeypatch.setattr(geolocation, 'location_stats', {stat: 0 for stat in geolocation.location_stats})
+    monkeypatch.setattr(geolocation, '_pending', set())
+    monkeypatch.setattr(geolocation, '_offline', {'ranges': None})
+    monkeypatch.setattr(geolocation, 'GEOIP_RANGES_FILE', None)
+    # No subscriber or scheduler threads in the tests
+    monkeypatch.setattr(app, 'start_worker', lambda: None)
+    monkeypatch.setattr(app, 'FLASK_ENV', 'production')
+    return client
+
+@pytest.fixture
+def ipinfo(http_stub, monkeypatch, redis_client):
+    # Local stand-in for ipinfo.io, answering STUB_LOCATION unless the test changes it
+    monkeypatch.setattr(geolocation, 'GEOLOCATION_URL', http_stub['url'] + '/{ip}/json')
+    monkeypatch.setattr(geolocation, 'GEOLOCATION_TIMEOUT_SECONDS', 2)
+    http_stub['respond'] = lambda path, query: (200, STUB_LOCATION, 0)
+    return http_stub
+
+def browse(client, path='/location-stats'):
+    return client.get(path, headers={'X-Forwarded-For': f'{IP}, 10.0.0.1'})
+
+def session_of(client):
+    with client.session_transaction() as session:
+        return dict(session)
+
+def wait_for_lookup(redis_client, ip=IP):
+    deadline = time.monotonic() + 5
+    while redis_client.get(f'user_location:{ip}') is None or ip in geolocation._pending:
+        assert time.monotonic() < deadline, 'the background lookup did not finish'
+        time.sleep(0.01)
+
+def test_defaults_are_served_while_the_location_is_looked_up(ipinfo, redis_client):
+    # ipinfo does not answer before the request is served
+    answer = threading.Event()
+    def slow(path, query):
+        answer.wait(5)
+        return 200, STUB_LOCATION, 0
+    ipinfo['respond'] = slow
+    client = app.server.test_client()
+
+    start = time.perf_counter()
+    response = browse(client)
+    elapsed = time.perf_counter() - start
+    answer.set()
+    # Left running, the lookup would write its result into the Redis of the next test
+    wait_for_lookup(redis_client)
+
+    assert response.status_code == 200
+    assert elapsed < 1
+    session = session_of(client)
+    assert (session['language'], session['lat'], session['lon'], session['city']) == ('pt-br', None, None, '')
+    assert session['location_pending']
+
+def test_the_location_fills_in_on_a_later_request(ipinfo, redis_client):
+    client = app.server.test_client()
+    browse(client)
+    wait_for_lookup(redis_client)
+
+    assert browse(client).status_code == 200
+
+    session = session_of(client)
+    assert (session['language'], session['lat'], session['lon'], session['city']) == ('pt-br', -31.7654, -52.3376, 'Pelotas')
+    assert not session['location_pending']
+    assert [path for path, _ in ipinfo['requests']] == [f'/{IP}/json']
+
+def test_a_failed_lookup_is_cached_and_fetched_once(ipinfo, redis_client):
+    ipinfo['respond'] = lambda path, query: (503, {'error': 'unavailable'}, 0)
+    client = app.server.test_client()
+    browse(client)
+    wait_for_lookup(redis_client)
+
+    for _ in range(3):
+        assert browse(client).status_code == 200
+    # Another session from the same address reads the cached failure too
+    assert browse(app.server.test_client()).status_code == 200
+
+    assert len(ipinfo['requests']) == 1
+    assert 0 < redis_client.ttl(f'user_location:{IP}') <= geolocation.GEOLOCATION_FAILURE_TTL_SECONDS
+    session = session_of(client)
+    assert (session['lat'], session['lon']) == (None, None)
+    assert not session['location_pending']
+    assert geolocation.get_location_stats()['failures'] == 1
+
+def test_asset_requests_skip_the_lookup(ipinfo, redis_client):
+    client = app.server.test_client()
+    browse(client, '/assets/favicon_io/favicon-32x32.png')
+    browse(client, '/_dash-component-suites/dash/dcc/dash_core_components.js')
+
+    assert ipinfo['requests'] == []
+    assert geolocation.get_location_stats()['lookups'] == 0
+
+def test_a_malformed_cached_location_falls_back_to_the_default(redis_client):
+    redis_client.set(f'user_location:{IP}', '{"loc": "n/a", "country": "BR"}')
+    client = app.server.test_client()
+
+    for _ in range(2):
+        assert browse(client).status_code == 200
+
+    session = session_of(client)
+    assert (session['language'], session['lat'], session['lon']) == ('pt-br', None, None)
+    assert not session['location_pending']
+
+def test_a_redis_error_falls_back_to_the_default(redis_client, monkeypatch):
+    def fail(ip, fetch):
+        raise ConnectionError('Redis is down')
+    monkeypatch.setattr(app, 'get_location', fail)
+    client = app.server.test_client()
+
+    assert browse(client).status_code == 200
+    assert not session_of(client)['location_pending']
+
+def test_the_offline_range_file_resolves_without_a_lookup(ipinfo, redis_client, tmp_path, monkeypatch):
+    ranges = tmp_path / 'ranges.csv'
+    ranges.write_text(
+        'start,end,country,city,latitude,longitude,timezone\n'
+        '198.51.100.0,198.51.100.255,US,Springfield,39.78,-89.65,America/Chicago\n'
+        '203.0.113.0,203.0.113.255,BR,Caxias do Sul,-29.1678,-51.1789,America/Sao_Paulo\n'
+    )
+    monkeypatch.setattr(geolocation, 'GEOIP_RANGES_FILE', str(ranges))
+
+    assert geolocation.resolve_offline('198.51.100.20')['city'] == 'Springfield'
+    assert geolocation.resolve_offline('192.0.2.1') is None
+    assert geolocation.resolve_offline('not an address') is None
+
+    client = app.server.test_client()
+    browse(client)
+
+    session = session_of(client)
+    assert (session['city'], session['lat'], session['lon']) == ('Caxias do Sul', -29.1678, -51.1789)
+    assert not session['location_pending']
+    assert ipinfo['requests'] == []
+    assert geolocation.get_location_stats()['offline'] == 1
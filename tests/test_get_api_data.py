@@ -0,0 +1,226 @@
+import threading
+import fakeredis
+import pytest
+import requests
+from tenacity import wait_none
+import get_api_data
+import snapshot
+import metrics
+from snapshot_format import decode_frame
+
+def make_shelter(number):
+    return {
+        'id': f'shelter-{number}',
+        'updatedAt': f'2024-05-{1 + number % 28:02d}T10:00:00.000Z',
+        'name': f'Abrigo {number}',
+        'address': f'Rua {number}, Porto Alegre',
+        'city': 'Porto Alegre',
+        'petFriendly': number % 2 == 0,
+        'shelteredPeople': number % 50,
+        'capacity': 100,
+        'contact': None,
+        'verified': True,
+        'latitude': -30.03,
+        'longitude': -51.23,
+        'actived': True,
+        'shelterSupplies': [],
+        'zipCode': '90000-000',
+    }
+
+def shelters_api(shelters, delay=0):
+    # /shelters pages over a list the test may change between requests, like the API does while shelters are added
+    def respond(path, query):
+        if path != '/shelters':
+            return 404, {}, 0
+        per_page, page = int(query['perPage']), int(query['page'])
+        current = shelters()
+        if query.get('orderBy') == 'updatedAt':
+            current = sorted(current, key=lambda shelter: shelter['updatedAt'], reverse=query.get('order') == 'desc')
+        return 200, {'data': {'results': current[(page - 1) * per_page:page * per_page], 'count': len(current)}}, delay
+    return respond
+
+@pytest.fixture
+def api(http_stub, monkeypatch):
+    monkeypatch.setattr(get_api_data, 'API_URL', http_stub['url'])
+    # Retries without the backoff, so the tests do not sleep
+    monkeypatch.setattr(get_api_data, 'fetch_page', get_api_data.fetch_page.retry_with(wait=wait_none()))
+    return http_stub
+
+def page_requests(stub, page):
+    return [query for path, query in stub['requests'] if path == '/shelters' and query['page'] == str(page)]
+
+def test_fetches_every_page(api):
+    shelters = [make_shelter(number) for number in range(250)]
+    api['respond'] = shelters_api(lambda: shelters, delay=0.02)
+
+    fetched, pages = get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    assert pages == 3
+    assert sorted(shelter.id for shelter in fetched) == sorted(shelter['id'] for shelter in shelters)
+    assert all(len(page_requests(api, page)) == 1 for page in range(1, 4))
+
+def test_paging_ends_when_the_count_changes(api):
+    # Every request adds shelters at the top of the list, shifting the others to later pages
+    shelters = [make_shelter(number) for number in range(250)]
+    lock = threading.Lock()
+    def growing():
+        with lock:
+            for _ in range(30):
+                shelters.insert(0, make_shelter(len(shelters)))
+            return list(shelters)
+    api['respond'] = shelters_api(growing, delay=0.01)
+
+    fetched, pages = get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    # Pages come from the first count, shelters seen on two pages are kept once
+    assert pages == 3
+    assert len(api['requests']) == 3
+    ids = [shelter.id for shelter in fetched]
+    assert len(ids) == len(set(ids))
+
+def test_duplicate_shelters_are_kept_once(api):
+    shelters = [make_shelter(number) for number in range(150)]
+    # The API sends shelter-0 again at the top of the second page
+    shelters[100] = make_shelter(0)
+    api['respond'] = shelters_api(lambda: shelters)
+
+    fetched, _ = get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    assert len(fetched) == 149
+    assert len({shelter.id for shelter in fetched}) == 149
+
+def test_retries_server_errors(api):
+    shelters = [make_shelter(number) for number in range(250)]
+    pages_api = shelters_api(lambda: shelters)
+    failures = {'2': 2}
+    def flaky(path, query):
+        if failures.get(query.get('page'), 0):
+            failures[query['page']] -= 1
+            return 503, {'message': 'Service Unavailable'}, 0
+        return pages_api(path, query)
+    api['respond'] = flaky
+
+    fetched, _ = get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    assert len(fetched) == 250
+    assert len(page_requests(api, 2)) == 3
+
+def test_gives_up_after_the_retries(api):
+    api['respond'] = lambda path, query: (503, {'message': 'Service Unavailable'}, 0)
+
+    with pytest.raises(requests.HTTPError):
+        get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    assert len(page_requests(api, 1)) == get_api_data.FETCH_RETRIES
+
+def test_slow_pages_time_out_and_are_retried(api, monkeypatch):
+    monkeypatch.setattr(get_api_data, 'FETCH_TIMEOUT_SECONDS', 0.2)
+    shelters = [make_shelter(number) for number in range(150)]
+    pages_api = shelters_api(lambda: shelters)
+    slow = {'2': 1}
+    def slow_once(path, query):
+        status, body, _ = pages_api(path, query)
+        if slow.get(query['page'], 0):
+            slow[query['page']] -= 1
+            return status, body, 1
+        return status, body, 0
+    api['respond'] = slow_once
+
+    fetched, _ = get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+    assert len(fetched) == 150
+    assert len(page_requests(api, 2)) == 2
+
+def test_always_slow_api_raises_a_timeout(api, monkeypatch):
+    monkeypatch.setattr(get_api_data, 'FETCH_TIMEOUT_SECONDS', 0.1)
+    shelters = [make_shelter(number) for number in range(50)]
+    api['respond'] = shelters_api(lambda: shelters, delay=0.5)
+
+    with pytest.raises(requests.Timeout):
+        get_api_data.fetch_shelter_data(get_api_data.new_schema_drift())
+
+def test_schema_drift_of_every_page_is_merged(api):
+    shelters = [make_shelter(number) for number in range(450)]
+    # One malformed shelter per page, fetched concurrently
+    for number in range(0, 450, 100):
+        shelters[number]['capacity'] = 'many'
+    shelters[0]['rescueTeam'] = 'Bombeiros'
+    for shelter in shelters:
+        del shelter['contact']
+    api['respond'] = shelters_api(lambda: shelters)
+
+    schema_drift = get_api_data.new_schema_drift()
+    fetched, _ = get_api_data.fetch_shelter_data(schema_drift)
+
+    assert len(fetched) == 445
+    report = get_api_data.report_schema_drift(schema_drift)
+    assert report['invalid_records'] == 5
+    assert report['unknown_fields'] == ['rescueTeam']
+    assert report['missing_fields'] == ['contact']
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = metrics.instrument_redis(fakeredis.FakeRedis(), 'refresh')
+    monkeypatch.setattr(get_api_data, 'client', client)
+    monkeypatch.setattr(get_api_data, 'FLASK_ENV', 'production')
+    monkeypatch.setattr(metrics, '_counters', {})
+    return client
+
+def redis_commands():
+    return {dict(key)['command']: count for key, count in metrics._counters['shelters_redis_commands_total'].items()}
+
+def test_refresh_round_trips_are_counted(api, redis_client):
+    shelters = [make_shelter(number) for number in range(150)]
+    api['respond'] = shelters_api(lambda: shelters)
+
+    stats = get_api_data.refresh()
+
+    assert stats['version'] == 1 and stats['rows_kept'] == 150
+    # The version read for encoding, then the transaction: WATCH and GET before MULTI, the writes in one round trip
+    assert redis_commands() == {'GET': 2, 'WATCH': 1, 'PIPELINE': 1, 'PUBLISH': 1}
+
+def test_snapshot_is_encoded_again_when_another_refresh_published_first(api, redis_client, monkeypatch):
+    shelters = [make_shelter(number) for number in range(10)]
+    api['respond'] = shelters_api(lambda: shelters)
+    encode_frame = get_api_data.encode_frame
+    def encode_then_publish(df, version):
+        # Another refresh publishes while this one encodes its snapshot
+        redis_client.incr(get_api_data.VERSION_KEY)
+        monkeypatch.setattr(get_api_data, 'encode_frame', encode_frame)
+        return encode_frame(df, version)
+    monkeypatch.setattr(get_api_data, 'encode_frame', encode_then_publish)
+
+    stats = get_api_data.refresh()
+
+    df, version = decode_frame(redis_client.get(get_api_data.SNAPSHOT_KEY))
+    assert stats['version'] == version == 2 and len(df) == 10
+
+def test_incremental_refresh_patches_the_snapshot_like_a_full_rebuild(api, redis_client, snapshot_dir, monkeypatch):
+    monkeypatch.setattr(snapshot, 'client', redis_client)
+    shelters = [make_shelter(number) for number in range(150)]
+    api['respond'] = shelters_api(lambda: shelters)
+    get_api_data.refresh()
+    snapshot.update_snapshot('1')
+    since = redis_client.get(get_api_data.UPDATED_AT_KEY).decode('utf-8')
+
+    # Fetched again at the stored watermark, unchanged: nothing to publish
+    assert get_api_data.refresh_incremental()['version'] is None
+
+    shelters[3].update(updatedAt='2024-06-01T08:00:00.000Z', shelteredPeople=99, name='Abrigo reformado')
+    shelters[4].update(updatedAt='2024-06-01T09:00:00.000Z', actived=False)
+    shelters.append({**make_shelter(150), 'updatedAt': '2024-06-02T10:00:00.000Z'})
+    # Same timestamp as the watermark, committed after the refresh that stored it
+    shelters.append({**make_shelter(151), 'updatedAt': since})
+    stats = get_api_data.refresh_incremental()
+    assert stats['version'] == 2 and (stats['rows_kept'], stats['rows_removed']) == (3, 1)
+    patched = snapshot.update_snapshot('2')
+
+    get_api_data.refresh()
+    rebuilt = snapshot.update_snapshot('3')
+
+    columns = [column for column in snapshot.get_frame(rebuilt).columns if column != 'city']
+    def frame(shared):
+        df = snapshot.get_frame(shared)
+        return df.assign(city=df['city'].astype(str))[columns + ['city']].sort_values('id').reset_index(drop=True)
+    assert len(patched['df']) == 151
+    snapshot.pd.testing.assert_frame_equal(frame(patched), frame(rebuilt))
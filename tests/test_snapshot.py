@@ -0,0 +1,185 @@
+import errno
+import os
+import time
+import types
+import pytest
+import snapshot
+
+class StopListening(Exception):
+    pass
+
+def stop(seconds):
+    # The subscriber sleeping before it reconnects ends the test
+    raise StopListening()
+
+class Clock:
+    # Stands in for the time module of snapshot, only moved by the waits of SilentPubSub
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        stop(seconds)
+
+class SilentPubSub:
+    # A half-open connection: commands are sent without an error and nothing ever comes back
+    def __init__(self, clock):
+        self.clock = clock
+        self.pings = 0
+        self.closed = False
+
+    def subscribe(self, channel):
+        pass
+
+    def get_message(self, timeout):
+        self.clock.now += timeout
+        return None
+
+    def ping(self):
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+
+class SilentClient:
+    def __init__(self, clock):
+        self.clock = clock
+        self.pubsubs = []
+
+    def pubsub(self):
+        self.pubsubs.append(SilentPubSub(self.clock))
+        return self.pubsubs[-1]
+
+@pytest.fixture
+def versions(monkeypatch):
+    # Versions swapped in by the subscriber, the data version in Redis is always '1'
+    swapped = []
+    monkeypatch.setattr(snapshot, 'get_data_version', lambda: '1')
+    monkeypatch.setattr(snapshot, 'update_snapshot', swapped.append)
+    monkeypatch.setattr(snapshot, '_subscriber', {'thread': None, 'checked_at': None})
+    return swapped
+
+def test_subscriber_reconnects_when_redis_stops_answering(monkeypatch, versions):
+    monkeypatch.setattr(snapshot, 'SUBSCRIBER_CHECK_SECONDS', 30)
+    clock = Clock()
+    monkeypatch.setattr(snapshot, 'time', clock)
+    fake_client = SilentClient(clock)
+    monkeypatch.setattr(snapshot, 'client', fake_client)
+
+    with pytest.raises(StopListening):
+        snapshot.listen_for_updates()
+
+    pubsub, = fake_client.pubsubs
+    # Pinged at 30 and 60 seconds, given up at 90 without an answer
+    assert pubsub.pings == 2
+    assert pubsub.closed
+    assert clock.now == 90
+    # The version is checked on subscribing and at every ping until the connection is given up
+    assert versions == ['1', '1', '1']
+    assert snapshot._subscriber['checked_at'] is None
+    assert not snapshot.subscriber_is_live()
+
+def test_callbacks_check_the_version_when_the_subscriber_is_stale(monkeypatch, versions):
+    monkeypatch.setattr(snapshot, '_snapshot', {'version': '0', 'df': object()})
+    monkeypatch.setattr(snapshot, 'SUBSCRIBER_CHECK_SECONDS', 30)
+
+    snapshot._subscriber['checked_at'] = snapshot.time.monotonic()
+    snapshot.get_snapshot()
+    assert versions == []
+
+    snapshot._subscriber['checked_at'] = snapshot.time.monotonic() - 61
+    snapshot.get_snapshot()
+    assert versions == ['1']
+
+def test_subscriber_swaps_in_published_versions(monkeypatch, versions):
+    fakeredis = pytest.importorskip('fakeredis')
+    fake_client = fakeredis.FakeRedis()
+    monkeypatch.setattr(snapshot, 'client', fake_client)
+    monkeypatch.setattr(snapshot, 'SUBSCRIBER_CHECK_SECONDS', 0.05)
+    monkeypatch.setattr(snapshot, 'time', types.SimpleNamespace(monotonic=time.monotonic, sleep=stop))
+    published = []
+    def publish_then_fail(version):
+        versions.append(version)
+        if version == '1' and not published:
+            published.append(fake_client.publish(snapshot.UPDATES_CHANNEL, '2'))
+        if version == '2':
+            raise StopListening()
+
+    monkeypatch.setattr(snapshot, 'update_snapshot', publish_then_fail)
+    with pytest.raises(StopListening):
+        snapshot.listen_for_updates()
+
+    assert published == [1]
+    assert versions[0] == '1' and versions[-1] == '2'
+
+def test_filtered_rows_are_row_numbers_of_the_snapshot(shared_snapshot):
+    df, shared = shared_snapshot
+    rows = snapshot.select_shelters(snapshot=shared, cities=('Canoas', 'Porto Alegre'), availability=(1, 3))
+
+    expected = df[df['city'].isin(['Canoas', 'Porto Alegre']) & df['availability'].isin([1, 3])]
+    assert rows.tolist() == expected.index.tolist()
+    assert not rows.flags.writeable
+
+def test_text_is_decoded_only_for_the_rows_and_columns_asked(shared_snapshot):
+    df, shared = shared_snapshot
+    rows = snapshot.select_shelters(snapshot=shared, search='escola')
+    page = shared['df'].take(rows[10:20])
+
+    decoded = snapshot.with_text(shared, page, ['name'])
+
+    assert 'address' not in decoded and 'id' not in decoded
+    assert decoded['name'].tolist() == df['name'].take(rows[10:20]).tolist()
+    assert snapshot.get_frame(shared, rows)['address'].tolist() == df['address'].take(rows).tolist()
+
+def test_a_stale_file_is_rejected_before_its_indexes_are_built(shared_snapshot, tmp_path, monkeypatch):
+    from snapshot_format import encode_shared_frame
+    df, _ = shared_snapshot
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_FILE', str(tmp_path / 'shelters.snapshot'))
+    (tmp_path / 'shelters.snapshot').write_bytes(encode_shared_frame(df, '1'))
+    read = []
+    read_snapshot = snapshot.read_snapshot
+    monkeypatch.setattr(snapshot, 'read_snapshot', lambda buffer: read.append(buffer) or read_snapshot(buffer))
+
+    assert snapshot.open_snapshot('2') is None
+    assert snapshot.open_snapshot(None) is None
+    assert read == []
+    assert snapshot.open_snapshot('1')['version'] == '1'
+    assert len(read) == 1
+
+def test_a_corrupt_file_is_not_mapped(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_FILE', str(tmp_path / 'shelters.snapshot'))
+    (tmp_path / 'shelters.snapshot').write_bytes(b'SHM1' + (100).to_bytes(8, 'little') + b'\xc1' * 100)
+
+    assert snapshot.open_snapshot('1') is None
+
+def test_the_snapshot_file_is_named_after_the_server_start(tmp_path):
+    import subprocess
+    import sys
+    code = 'import snapshot; print(snapshot.SNAPSHOT_FILE)'
+    env = {'SNAPSHOT_DIR': str(tmp_path), 'PATH': ''}
+    def snapshot_file(**extra):
+        return subprocess.run([sys.executable, '-c', code], env={**env, **extra}, capture_output=True, text=True, check=True).stdout.strip()
+
+    assert snapshot_file(SNAPSHOT_RUN_ID='abc') == snapshot_file(SNAPSHOT_RUN_ID='abc') == str(tmp_path / 'shelters-abc.snapshot')
+    # Without a token, every process writes its own file
+    assert snapshot_file() != snapshot_file()
+
+def test_building_a_snapshot_removes_the_files_of_other_runs(shared_snapshot, snapshot_dir, monkeypatch):
+    df, _ = shared_snapshot
+    for name in ['shelters-previous.snapshot', 'shelters-123-0a1b.snapshot', 'notes.txt']:
+        (snapshot_dir / name).write_bytes(b'left over')
+    monkeypatch.setattr(snapshot, 'build_snapshot', lambda version: snapshot.share_snapshot(version, df.copy()))
+
+    assert snapshot.update_snapshot('2')['version'] == '2'
+    assert sorted(os.listdir(snapshot_dir)) == ['notes.txt', 'shelters-current.snapshot', 'shelters.lock']
+
+def test_a_snapshot_file_not_written_leaves_no_partial_file(shared_snapshot, snapshot_dir, monkeypatch):
+    df, _ = shared_snapshot
+    def disk_full(source, destination):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(snapshot.os, 'replace', disk_full)
+
+    assert snapshot.share_snapshot('2', df.copy())['version'] == '2'
+    assert os.listdir(snapshot_dir) == []